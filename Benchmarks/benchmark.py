@@ -0,0 +1,314 @@
+import numpy as np
+import os
+import sys
+import argparse
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXT_DIR = os.path.join(ROOT_DIR, "Text_Preprocessing")
+IMAGE_DIR = os.path.join(ROOT_DIR, "Image_Preprocessing")
+TEXT_SCRIPT = os.path.join(TEXT_DIR, "clean_text.py")
+IMAGE_SCRIPT = os.path.join(IMAGE_DIR, "clean_image.py")
+# Command line tools whose startup time (running them with --help) is measured
+STARTUP_SCRIPTS = {"text": ["clean_text.py", "ingress_text.py"], "image": ["clean_image.py", "ingress_image.py", "inspect_image.py"]}
+# Tools are started many times as the time of a single start is short and noisy. The fastest start is reported.
+STARTUP_REPEAT = 10
+
+TEXT_LABELS = ["news/sport", "news/tech", "blog", "reviews/positive", "reviews/negative"]
+IMAGE_LABELS = ["cats", "dogs/small", "dogs/large", "birds"]
+# Document sizes in words and image resolutions (square side in pixels) drawn from for the synthetic datasets
+TEXT_SIZES = [10, 100, 1000, 10000]
+IMAGE_SIZES = [32, 64, 128, 256]
+IMAGE_CHANNELS = [1, 3, 4]
+IMAGE_EXTS = [".png", ".jpg"]
+WORDS = "the of and to in is was he for it with as his on be at by had are but from or have an they which one you were her all she there would their we him been has when who will more no if out so said what up its about into than them can only other new some could time these two may then do first any my now such like our over man me even most made after also did many before must through back years where much your way well down should because each just those people how too little state good very make world still own see men work long get here between both life being under never day same another know while last might us great old year off come since against go came right used take three".split()
+PUNCTUATION = [",", ".", "!", "?", ";", ":", " -", "'s", " 42", " 2024"]
+
+
+def gettextdata(directory, count, seed=0):
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        labels = TEXT_LABELS[i % len(TEXT_LABELS)]
+        folder = os.path.join(directory, labels)
+        os.makedirs(folder, exist_ok=True)
+        size = int(rng.choice(TEXT_SIZES))
+        words = rng.choice(WORDS, size)
+        marks = rng.choice(PUNCTUATION, size)
+        keep = rng.random(size) < 0.1
+        text = ""
+        for j, word in enumerate(words):
+            text += word
+            if keep[j]:
+                text += marks[j]
+            text += "\n" if j % 12 == 11 else " "
+        with open(os.path.join(folder, "document" + str(i) + ".txt"), "w") as file:
+            file.write(text)
+
+def getimagedata(directory, count, seed=0):
+    import cv2
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        labels = IMAGE_LABELS[i % len(IMAGE_LABELS)]
+        folder = os.path.join(directory, labels)
+        os.makedirs(folder, exist_ok=True)
+        size = int(rng.choice(IMAGE_SIZES))
+        channels = int(rng.choice(IMAGE_CHANNELS))
+        ext = IMAGE_EXTS[i % len(IMAGE_EXTS)]
+        if ext == ".jpg" and channels == 4:
+            channels = 3
+        # Smooth gradients with noise so that the images compress like photographs rather than pure noise
+        gradient = np.linspace(0, 255, size, dtype=np.float64)
+        image = (gradient[:, None] + gradient[None, :]) / 2
+        image = np.repeat(image[:, :, None], channels, axis=2)
+        image += rng.normal(0, 20, image.shape)
+        image = np.clip(image, 0, 255).astype(np.uint8)
+        if channels == 1:
+            image = image[:, :, 0]
+        cv2.imwrite(os.path.join(folder, "image" + str(i) + ext), image)
+
+def getsize(directory):
+    size = 0
+    count = 0
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+            count += 1
+    return count, size
+
+# Run a command in a child process and return the wall time and the peak resident set size (in MB) of the child
+def runchild(command):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError("Benchmark command failed: " + " ".join(command))
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = usage.ru_maxrss / 1024
+    if sys.platform == "darwin":
+        peak /= 1024
+    return elapsed, peak
+
+def getresult(elapsed, count, size, peak=None):
+    result = {"seconds": round(elapsed, 4), "files_per_second": round(count / elapsed, 2), "mb_per_second": round(size / elapsed / 1024 / 1024, 3)}
+    if peak is not None:
+        result["peak_rss_mb"] = round(peak, 1)
+    return result
+
+def benchend(script, source, workdir, options, count, size, repeat=1):
+    best = None
+    for i in range(repeat):
+        target = os.path.join(workdir, "output")
+        shutil.rmtree(target, ignore_errors=True)
+        command = [sys.executable, script, target, "-s", source, "-q"] + options
+        elapsed, peak = runchild(command)
+        if best is None or elapsed < best[0]:
+            best = (elapsed, peak)
+    shutil.rmtree(os.path.join(workdir, "output"), ignore_errors=True)
+    return getresult(best[0], count, size, peak=best[1])
+
+# Time starting a tool and parsing its arguments, which every run pays before doing any work
+def benchstartup(script, repeat=STARTUP_REPEAT):
+    best = min([runchild([sys.executable, script, "--help"])[0] for i in range(repeat)])
+    return {"seconds": round(best, 4)}
+
+# Time a single stage over every input. The stage is run once per input and its output is passed to the next stage.
+def timestage(stage, inputs):
+    outputs = []
+    start = time.perf_counter()
+    for item in inputs:
+        outputs.append(stage(item))
+    return time.perf_counter() - start, outputs
+
+# List the files of a directory tree with the scanner of the tool being benchmarked
+def listfiles(directory, scantree):
+    files = []
+    for root, names in scantree(directory):
+        for name in names:
+            files.append(os.path.join(root, name))
+    return files
+
+def benchtextstages(source, workdir, count, size):
+    sys.path.insert(0, TEXT_DIR)
+    import clean_text as ct
+    import common_text
+    target = os.path.join(workdir, "stages")
+    os.makedirs(target, exist_ok=True)
+    results = {}
+    elapsed, files = timestage(lambda directory: listfiles(directory, common_text.scantree), [source])
+    results["walk"] = getresult(elapsed, count, size)
+    files = files[0]
+    elapsed, texts = timestage(ct.gettext, files)
+    results["read"] = getresult(elapsed, count, size)
+    elapsed, texts = timestage(ct.formattext, texts)
+    results["format"] = getresult(elapsed, count, size)
+    elapsed, metas = timestage(ct.getmeta, texts)
+    results["meta"] = getresult(elapsed, count, size)
+    names = iter(range(len(texts)))
+    elapsed, paths = timestage(lambda text: ct.savetext(text, str(next(names)), target), texts)
+    results["save"] = getresult(elapsed, count, size)
+    shutil.rmtree(target, ignore_errors=True)
+    return results
+
+def benchimagestages(source, workdir, count, size):
+    sys.path.insert(0, IMAGE_DIR)
+    import clean_image as ci
+    import inspect_image as ii
+    import common_image
+    target = os.path.join(workdir, "stages")
+    os.makedirs(target, exist_ok=True)
+    results = {}
+    elapsed, files = timestage(lambda directory: listfiles(directory, common_image.scantree), [source])
+    results["walk"] = getresult(elapsed, count, size)
+    files = files[0]
+    elapsed, images = timestage(ci.readimage, files)
+    results["decode"] = getresult(elapsed, count, size)
+    elapsed, headers = timestage(ii.inspectimage, files)
+    results["header"] = getresult(elapsed, count, size)
+    elapsed, useful = timestage(lambda image: ci.checkuseful(image, ci.getchannels(image.shape)), images)
+    results["useful"] = getresult(elapsed, count, size)
+    elapsed, images = timestage(ci.formatimage, images)
+    results["format"] = getresult(elapsed, count, size)
+    elapsed, flats = timestage(lambda image: ci.flatten(image)[1], images)
+    results["flatten"] = getresult(elapsed, count, size)
+    names = iter(range(len(flats)))
+    elapsed, paths = timestage(lambda flat: ci.saveimage(flat, str(next(names)), target), flats)
+    results["save"] = getresult(elapsed, count, size)
+    shutil.rmtree(target, ignore_errors=True)
+    return results
+
+# Export the dataset uncompressed and compressed with every installed codec, in every storage that can be compressed,
+# and check that every compressed output reads back to the same data. Returns the storages and codecs checked.
+def checkroundtrip(tool, source, workdir):
+    if tool == "text":
+        sys.path.insert(0, TEXT_DIR)
+        import common_text as common
+        import ingress_text as ingress
+        script, options, read, storages = TEXT_SCRIPT, [], ingress.getdocument, ["text"]
+    else:
+        sys.path.insert(0, IMAGE_DIR)
+        import common_image as common
+        import ingress_image as ingress
+        script, options, read, storages = IMAGE_SCRIPT, ["-e", "16"], ingress.getimage, ["text", "npy"]
+    checked = []
+    for storage in storages:
+        exports = {}
+        for codec in [None] + common.COMPRESSION_CODECS:
+            if codec is not None and not common.checkcodec(codec):
+                continue
+            target = os.path.join(workdir, "roundtrip_" + storage + "_" + str(codec))
+            shutil.rmtree(target, ignore_errors=True)
+            compress = ["-c", "--codec", codec] if codec else []
+            runchild([sys.executable, script, target, "-s", source, "-q", "--storage", storage] + options + compress)
+            exports[codec] = [read(meta) for meta in ingress.readmeta(os.path.join(target, "metadata.csv"))]
+            shutil.rmtree(target, ignore_errors=True)
+        expected = exports.pop(None)
+        for codec, data in exports.items():
+            if len(data) != len(expected) or not all([np.array_equal(a, b) for a, b in zip(data, expected)]):
+                raise RuntimeError("Output of " + storage + " storage compressed with " + codec + " does not read back as the uncompressed output.")
+            checked.append(storage + " " + codec)
+    return checked
+
+def getcommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def printresults(results, baseline=None):
+    for tool in ["text", "image"]:
+        if tool not in results:
+            continue
+        for group in ["end_to_end", "stages"]:
+            for name, result in results[tool][group].items():
+                line = tool + " " + name + ": " + str(result["files_per_second"]) + " files/s, " + str(result["mb_per_second"]) + " MB/s"
+                if "peak_rss_mb" in result:
+                    line += ", peak RSS " + str(result["peak_rss_mb"]) + " MB"
+                if baseline:
+                    try:
+                        old = baseline[tool][group][name]["files_per_second"]
+                        line += " (" + str(round(result["files_per_second"] / old, 2)) + "x baseline)"
+                    except (KeyError, ZeroDivisionError):
+                        pass
+                print(line)
+        for name, result in results[tool].get("startup", {}).items():
+            line = tool + " startup " + name + ": " + str(round(result["seconds"] * 1000, 1)) + " ms"
+            if baseline:
+                try:
+                    old = baseline[tool]["startup"][name]["seconds"]
+                    line += " (" + str(round(result["seconds"] / old, 2)) + "x baseline)"
+                except (KeyError, ZeroDivisionError):
+                    pass
+            print(line)
+        if "roundtrip" in results[tool]:
+            print(tool + " round trip of compressed storage: " + ", ".join(results[tool]["roundtrip"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the text and image preprocessing tools on synthetic labeled datasets. The datasets are generated from a fixed seed so that results are comparable across commits. Each tool is run end to end in a child process, each stage of its pipeline is timed on its own, the startup time of every command line tool is measured and compressed output is checked to read back unchanged. Throughput is reported in files per second and megabytes of source data per second along with the peak resident memory of end to end runs.")
+    parser.add_argument("-o", "--output", type=str, help="Path to a JSON file to store the results in.")
+    parser.add_argument("-b", "--baseline", type=str, help="Path to the JSON results of an earlier run to compare against.")
+    parser.add_argument("-d", "--data", type=str, help="Directory in which the synthetic datasets are generated (or reused if they already exist). Defaults to a temporary directory.")
+    parser.add_argument("-t", "--texts", type=int, default=2000, help="Number of synthetic documents.")
+    parser.add_argument("-i", "--images", type=int, default=200, help="Number of synthetic images.")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of times each end to end run is repeated. The fastest run is reported.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic datasets.")
+    parser.add_argument("--skip", choices=["text", "image"], action="append", default=[], help="Skip benchmarking a tool.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of workers used by the parallel end to end runs.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Suppress ouptut to the console.")
+
+    args = parser.parse_args()
+
+    workdir = args.data if args.data else tempfile.mkdtemp(prefix="preprocessing_benchmark_")
+    results = {"commit": getcommit(), "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(), "seed": args.seed}
+    try:
+        if "text" not in args.skip:
+            source = os.path.join(workdir, "text_" + str(args.texts) + "_" + str(args.seed))
+            if not os.path.isdir(source):
+                gettextdata(source, args.texts, seed=args.seed)
+            count, size = getsize(source)
+            results["text"] = {"files": count, "bytes": size, "end_to_end": {}, "stages": {}}
+            runs = {"serial": [], "compress": ["-c"], "shard": ["--storage", "shard"], "parallel": ["-w", str(args.workers)], "dedup": ["--dedup", "minhash"], "columnar": ["--metaformat", "npy"], "vocab": ["--vocab"], "stream": ["--streamsize", "0.001"]}
+            for name, options in runs.items():
+                results["text"]["end_to_end"][name] = benchend(TEXT_SCRIPT, source, workdir, options, count, size, repeat=args.repeat)
+            results["text"]["stages"] = benchtextstages(source, workdir, count, size)
+            results["text"]["roundtrip"] = checkroundtrip("text", source, workdir)
+            results["text"]["startup"] = {name: benchstartup(os.path.join(TEXT_DIR, name)) for name in STARTUP_SCRIPTS["text"]}
+        if "image" not in args.skip:
+            source = os.path.join(workdir, "image_" + str(args.images) + "_" + str(args.seed))
+            if not os.path.isdir(source):
+                getimagedata(source, args.images, seed=args.seed)
+            count, size = getsize(source)
+            results["image"] = {"files": count, "bytes": size, "end_to_end": {}, "stages": {}}
+            # The cache is filled by the first repeat of the cached run, the fastest (warm) repeat is reported
+            cache = os.path.join(workdir, "cache")
+            shutil.rmtree(cache, ignore_errors=True)
+            runs = {"serial": [], "resize": ["-e", "64"], "multisize": ["-e", "64", "-e", "32"], "npy": ["--storage", "npy"], "float16": ["-f", "--floattype", "float16", "--storage", "npy"], "quantized": ["-f", "--floattype", "uint8", "--storage", "shard"], "shard": ["--storage", "shard"], "parallel": ["-w", str(args.workers)], "cached": ["--cache", cache], "dedup": ["--dedup", "phash"]}
+            for name, options in runs.items():
+                results["image"]["end_to_end"][name] = benchend(IMAGE_SCRIPT, source, workdir, options, count, size, repeat=args.repeat)
+            shutil.rmtree(cache, ignore_errors=True)
+            results["image"]["stages"] = benchimagestages(source, workdir, count, size)
+            results["image"]["roundtrip"] = checkroundtrip("image", source, workdir)
+            results["image"]["startup"] = {name: benchstartup(os.path.join(IMAGE_DIR, name)) for name in STARTUP_SCRIPTS["image"]}
+    finally:
+        if not args.data:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+    if not args.quiet:
+        printresults(results, baseline=baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,63 @@
 import numpy as np
-import cv2
 import os
 import sys
 import argparse
-from skimage import io, color, img_as_float, img_as_ubyte
+import functools
+import multiprocessing
+import signal
+import json
+import hashlib
+import cProfile
+import tracemalloc
+import threading
+import concurrent.futures
+import sqlite3
+import csv
+
+from common_image import NPY_IMAGE_EXT, SHARD_OFFSET_SEP, COMPRESSION_CODECS, METADATA_BATCHSIZE, SCAN_THREADS, QUANTIZE_SCALE, QUANTIZE_OFFSET
+from common_image import importpil, quantformat, checkdirs, checkcodec, codecext, opencompressed, splitlocator, timestage, Stats, walkfiles, imapwindow, RecordWriter, openrecords, createdir
+# OpenCV and scikit-image are imported by the functions that use them, which keeps startup fast
 
 
 METADATA_FILENAME = "metadata.csv"
 UNLABELED_FILENAME = "unlabeled.csv"
 USELESS_FILENAME = "useless.csv"
+DUPLICATES_FILENAME = "duplicates.csv"
 FLAT_IMAGE_EXT = ".csv"
+SHARD_FILENAME = "shard_"
+SHARD_EXT = ".bin"
+# Byte alignment of each image within a shard so that views of any dtype are aligned
+SHARD_ALIGNMENT = 64
+STORAGE_TYPES = ["text", "npy", "shard"]
+WRITER_PENDING = 64
+MANIFEST_FILENAME = "manifest.jsonl"
+HASH_CHUNKSIZE = 1024 * 1024
+TEMP_FILE_PREFIX = "tmp_"
+# Number of pixels examined at a time by the usefulness checks
+USEFUL_CHUNKSIZE = 65536
+# Values within this fraction of the minimum or maximum value count as black or white
+BLANK_TOLERANCE = 0.02
+WORKER_CHUNKSIZE = 16
+# Chunks of files fingerprinted ahead of the deduplication, per worker
+FINGERPRINT_WINDOW = 4
+DEDUP_METHODS = ["exact", "ahash", "phash"]
+# Number of bits of the perceptual hashes and the default maximum number of differing bits of near duplicates
+HASH_BITS = 64
+HASH_DISTANCE = 4
+# squash: stretch to m x m, fit: scale the longer side to m and pad to m x m, crop: scale the shorter side to m and
+# crop the centre m x m, short: scale the shorter side to m keeping the aspect ratio
+RESIZE_MODES = ["squash", "fit", "crop", "short"]
+# Image modes which Pillow converts to 8 bit greyscale or RGB without losing precision
+FAST_DECODE_MODES = ["1", "L", "LA", "P", "PA", "RGB", "RGBA", "CMYK", "YCbCr"]
+# Types float values (0-1) can be stored as. uint8 stores values quantized as round((value - QUANTIZE_OFFSET) /
+# QUANTIZE_SCALE), with the scale and offset recorded in the value format of the metadata.
+FLOAT_TYPES = ["float64", "float32", "float16", "uint8"]
+# Digits written to text files for each float type, enough to restore the stored value exactly
+TEXT_FLOAT_FORMATS = {"float64": "%.17g", "float32": "%.9g", "float16": "%.5g"}
+# Each process evicts cache entries once it has added this fraction of the maximum cache size
+CACHE_PRUNE_FRACTION = 0.1
 
 
-def removeaffix(string, prefix=None, suffix=None):
-    if prefix:
-        try:
-            string = string.removeprefix(prefix)
-        except:
-            if string.startswith(prefix):
-                string = string[len(prefix):]
-    if suffix:
-        try:
-            string = string.removesuffix(suffix)
-        except:
-            if string.endswith(suffix):
-                string = string[:-len(suffix)]
-    return string
-
-def trimpathsep(path, leading=True, trailing=True):
-    if leading and trailing:
-        return path.strip(os.sep)
-    elif leading:
-        return path.lstrip(os.sep)
-    elif trailing:
-        return path.rstrip(os.sep)
-
-def checkdirs(dirs, label="", verbose=False, quiet=False):
-    invalid = False
-    for dir in dirs:
-        invalid = checkdir(dir, label=label, verbose=verbose, quiet=quiet)
-        if invalid and not verbose:
-            return invalid
-    return invalid
-
-def checkdir(directory, label="", verbose=False, quiet=False):
-    if not os.path.isdir(directory):
-        if verbose:
-            print("The " + label + " directory: '" + dir + "'" + " does not exist.")
-        elif not quiet:
-            print("Some " + label + " path(s) are invalid.")
-        return True
-    return False
-
-def modfilename(path, prefix="", suffix=""):
-    root, file = os.path.split(path)
-    file, ext = os.path.splitext(file)
-    file = prefix + file + suffix
-    return os.path.join(root, file + ext)
-
-def getlabels(path, delimiter=os.sep, verbose=False):
-    labels = path.split(delimiter)
-    if verbose:
-        if labels[0]:
-            print("The labels for image are: " + str(labels))
-    return labels
-
 def getchannels(shape):
     channels = 0
     try:
@@ -73,23 +66,92 @@ def getchannels(shape):
         channels = 1
     return channels
 
-def checkuseful(image, channels, verbose=False):
-    if channels > 1:
-        image = color.rgb2gray(image)
-    min = np.min(image)
-    max = np.max(image)
-    if min == max:
+# Pixels as rows of channel values without copying the image
+def getpixels(image, channels):
+    return image.reshape(-1, channels)
+
+def getscale(image):
+    if np.issubdtype(image.dtype, np.integer):
+        return np.iinfo(image.dtype).max
+    return 1
+
+# Compare every pixel against the first one, a chunk at a time, and stop at the first pixel that differs
+def checkconstant(image, channels, chunksize=USEFUL_CHUNKSIZE):
+    pixels = getpixels(image, channels)
+    first = pixels[0]
+    for start in range(0, len(pixels), chunksize):
+        if (pixels[start:start + chunksize] != first).any():
+            return False
+    return True
+
+# Variance of all values (scaled to 0-1) accumulated a chunk at a time. Values are shifted by the first value to keep
+# the sums numerically stable.
+def getvariance(image, channels, chunksize=USEFUL_CHUNKSIZE):
+    pixels = getpixels(image, channels)
+    shift = np.float64(pixels[0, 0])
+    total = 0.0
+    squares = 0.0
+    for start in range(0, len(pixels), chunksize):
+        chunk = pixels[start:start + chunksize].astype(np.float64) - shift
+        total += chunk.sum()
+        squares += np.square(chunk).sum()
+    count = pixels.size
+    variance = squares / count - (total / count) ** 2
+    return max(variance, 0.0) / getscale(image) ** 2
+
+# Fraction of pixels where every channel is (near) black or every channel is (near) white
+def getblank(image, channels, tolerance=BLANK_TOLERANCE, chunksize=USEFUL_CHUNKSIZE):
+    pixels = getpixels(image, channels)
+    scale = getscale(image)
+    low = tolerance * scale
+    high = scale - low
+    blank = 0
+    for start in range(0, len(pixels), chunksize):
+        chunk = pixels[start:start + chunksize]
+        blank += np.count_nonzero((chunk <= low).all(axis=1) | (chunk >= high).all(axis=1))
+    return blank / len(pixels)
+
+# Runs on the decoded image before it is resized so that useless images are rejected as early as possible. Transparent
+# images are checked as they are exported, blended onto white. minvariance: minimum variance of the values scaled to
+# 0-1, maxblank: maximum fraction of black or white pixels.
+def checkuseful(image, channels, minvariance=0, maxblank=0, verbose=False):
+    if image.size == 0:
+        if verbose:
+            print("Image is empty. No useful data contained.")
+        return False
+    if channels == 4:
+        from skimage import color
+        image = color.rgba2rgb(image)
+        channels = 3
+    if checkconstant(image, channels):
         if verbose:
             print("Image is one colour. No useful data contained.")
         return False
+    if minvariance and getvariance(image, channels) < minvariance:
+        if verbose:
+            print("Image variance is below the minimum. Not enough useful data contained.")
+        return False
+    if maxblank and getblank(image, channels) > maxblank:
+        if verbose:
+            print("Image is mostly blank. Not enough useful data contained.")
+        return False
     return True
 
-def formatimage(image, float=False):
+def formatimage(image, float=False, floattype="float64"):
+    from skimage import img_as_float, img_as_ubyte
     if float:
-        return img_as_float(image)
+        image = img_as_float(image)
+        if floattype == "uint8":
+            return quantizeimage(image)
+        return image.astype(floattype, copy=False)
     else:
         return img_as_ubyte(image)
 
+# Quantize float values to uint8 with the dataset scale and offset. Restored values are off by at most half the scale.
+def quantizeimage(image, scale=QUANTIZE_SCALE, offset=QUANTIZE_OFFSET):
+    image = np.rint((image - offset) / scale)
+    return np.clip(image, 0, 255, out=image).astype(np.uint8)
+
 def flatten(image, verbose=False):
     if verbose:
         res_y = str(image.shape[0])
@@ -97,110 +159,751 @@ def flatten(image, verbose=False):
         print("Image prior to flattening has a resolution of : " + res_x + " x " + res_y + " pixels.")
     return (image.shape, image.flatten())
 
-def saveimage(image, filename, directory, float=False, compress=False, abspath=False):
+def outputpath(filename, directory, compress=False, abspath=False, storage="text", codec="gzip"):
     ext = FLAT_IMAGE_EXT
+    if storage == "npy":
+        ext = NPY_IMAGE_EXT
     if compress:
-        ext += ".gz"
+        ext += codecext(codec)
     filepath = os.path.join(directory, filename + ext)
     if abspath:
         filepath = os.path.abspath(filepath)
-    format = '%d'
-    if float:
-        format = '%.f' #'%.18e'
-    np.savetxt(filepath, image, fmt=format)
     return filepath
 
-def exportmeta(data, path, float=False):
-    filepath = iteratefilename(os.path.join(path, METADATA_FILENAME), prefix="_")
-    try:
-        file = open(filepath, 'x')
-    except:
-        print("SOMETHING IS WRONG THIS SHOULD NEVER BE REACHED.")
-        sys.exit()
-    for image in data:
-        labels, shape, imagepath = image
-        # labels: num labels followed by each label
-        file.write(str(len(labels)) + " ")
-        for label in labels:
-            label = "_".join(label.split())
-            file.write(str(label) + " ")
-        # shape data
-        shapelen = getchannels(shape)
-        if shapelen == 1:
-            shapelen = 2
-        file.write(str(shapelen) + " ")
-        for i in range(shapelen):
-            file.write(str(shape[i]) + " ")
-        # format of image file (int or float)
+def saveimage(image, filename, directory, compress=False, abspath=False, storage="text", codec="gzip", level=None):
+    filepath = outputpath(filename, directory, compress=compress, abspath=abspath, storage=storage, codec=codec)
+    writeimage(image, filepath, compress=compress, storage=storage, codec=codec, level=level)
+    return filepath
+
+# Values are written to text files with the precision of their type (integers for int and quantized images)
+def writeimage(image, filepath, compress=False, storage="text", codec="gzip", level=None):
+    format = TEXT_FLOAT_FORMATS.get(image.dtype.name, '%d')
+    if compress:
+        with opencompressed(filepath, codec=codec, level=level) as file:
+            if storage == "npy":
+                np.save(file, image)
+            else:
+                np.savetxt(file, image, fmt=format)
+    elif storage == "npy":
+        np.save(filepath, image)
+    else:
+        np.savetxt(filepath, image, fmt=format)
+
+# Runs file writes (and their compression) on a pool of threads. At most 'pending' writes are queued at once so the
+# processing loop is held back instead of buffering an unbounded amount of output in memory. With 'fsync' set, written
+# files are synced to stable storage in batches of that many files rather than one at a time.
+class BackgroundWriter:
+    def __init__(self, threads, pending=WRITER_PENDING, fsync=0):
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.pending = pending
+        self.slots = threading.BoundedSemaphore(pending)
+        self.errors = []
+        self.fsync = fsync
+        self.unsynced = []
+        self.lock = threading.Lock()
+
+    # Write the file at filepath by calling func(*args, **kwargs) on a writer thread
+    def submit(self, filepath, func, *args, **kwargs):
+        # Stop at the first failed write instead of processing everything else for nothing
+        if self.errors:
+            raise self.errors[0]
+        self.slots.acquire()
+        future = self.executor.submit(self.run, filepath, func, args, kwargs)
+        future.add_done_callback(self.done)
+        return future
+
+    def run(self, filepath, func, args, kwargs):
+        func(*args, **kwargs)
+        if self.fsync:
+            with self.lock:
+                self.unsynced.append(filepath)
+                if len(self.unsynced) < self.fsync:
+                    return
+                batch = self.unsynced
+                self.unsynced = []
+            syncfiles(batch)
+
+    # The slot is only given back once a failure is recorded, so drain never misses the error of the last writes
+    def done(self, future):
+        try:
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+        finally:
+            self.slots.release()
+
+    # Sync every file written so far which has not been synced yet
+    def sync(self):
+        with self.lock:
+            batch = self.unsynced
+            self.unsynced = []
+        syncfiles(batch)
+
+    # Wait until every write submitted so far has finished (and is synced when syncing)
+    def drain(self):
+        for slot in range(self.pending):
+            self.slots.acquire()
+        for slot in range(self.pending):
+            self.slots.release()
+        if self.errors:
+            raise self.errors[0]
+        self.sync()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+        self.sync()
+
+# Flush files to stable storage followed by the directories holding them, so that their names are durable as well.
+# Directories cannot be synced on every platform.
+def syncfiles(filepaths):
+    directories = set()
+    for filepath in filepaths:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(filepath) or os.curdir)
+    for directory in directories:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def checkoutput(path):
+    shardpath, offset = splitlocator(path)
+    if offset is not None:
+        return os.path.isfile(shardpath) and os.path.getsize(shardpath) > offset
+    return os.path.isfile(path)
+
+# Remove an output file. Images inside a shard are left in place.
+def removeoutput(path):
+    shardpath, offset = splitlocator(path)
+    if offset is None and os.path.isfile(path):
+        os.remove(path)
+
+# Appends flat images as raw bytes to large shard files. Each image is referenced by a locator holding the shard
+# path and byte offset; together with the shape and dtype in the metadata any image can be memory mapped directly.
+class ShardWriter:
+    def __init__(self, directory, shardsize, abspath=False, fsync=False):
+        self.directory = directory
+        self.shardsize = shardsize
+        self.abspath = abspath
+        self.fsync = fsync
+        self.index = 0
+        self.file = None
+        self.path = None
+        self.offset = 0
+
+    def open(self):
+        # Never append to or replace shards of an earlier run, their images may still be referenced
+        self.path = self.shardpath(self.index)
+        while os.path.exists(self.path):
+            self.index += 1
+            self.path = self.shardpath(self.index)
+        self.file = open(self.path, "xb")
+        self.offset = 0
+        self.index += 1
+
+    def shardpath(self, index):
+        path = os.path.join(self.directory, SHARD_FILENAME + str(index).zfill(5) + SHARD_EXT)
+        if self.abspath:
+            path = os.path.abspath(path)
+        return path
+
+    def write(self, image):
+        data = np.ascontiguousarray(image)
+        if self.file is None or (self.offset > 0 and self.offset + data.nbytes > self.shardsize):
+            self.close()
+            self.open()
+        padding = -self.offset % SHARD_ALIGNMENT
+        if padding:
+            self.file.write(bytes(padding))
+            self.offset += padding
+        locator = self.path + SHARD_OFFSET_SEP + str(self.offset)
+        self.file.write(data.tobytes())
+        self.offset += data.nbytes
+        return locator
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+# Output (or metadata) directory of each size. With several sizes every size is stored in its own subdirectory.
+def sizedirs(directory, sizes):
+    if len(sizes) == 1:
+        return [directory]
+    return [os.path.join(directory, str(size)) for size in sizes]
+
+# Value format of the flattened image as written to the metadata file. Quantized float values carry the scale and
+# offset to restore them.
+def dataformat(float=False, storage="text", floattype="float64"):
+    if float and floattype == "uint8":
+        return quantformat("uint8", QUANTIZE_SCALE, QUANTIZE_OFFSET)
+    if storage == "text":
         if float:
-            file.write("float ")
-        else:
-            file.write("int ")
-        # path to the flattened image file (.csv)
-        file.write(imagepath + "\n")
-    file.close()
+            return "float" if floattype == "float64" else floattype
+        return "int"
+    if float:
+        return floattype
+    return "uint8"
+
+# Start the optional profilers of the main process
+def startprofile(profile=None, tracemem=0):
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if tracemem:
+        tracemalloc.start()
+    return profiler
+
+# Stop the profilers. The cProfile statistics are written to the profile file and the largest allocation sites found
+# by tracemalloc are returned so they can be added to the stats file.
+def stopprofile(profiler, profile=None, tracemem=0):
+    extra = {}
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile)
+    if tracemem:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        top = snapshot.statistics("lineno")[:tracemem]
+        extra["memory"] = {"current_bytes": current, "peak_bytes": peak, "top": [{"location": str(stat.traceback), "bytes": stat.size, "count": stat.count} for stat in top]}
+    return extra
 
-def createdir(directory, label='', clean=False, verbose=False, quiet=False):
-    if not os.path.isdir(directory):
-        if not quiet:
-            print("The " + label + " directory '" + directory + "' does not exist. Creating directory...")
+# On disk cache of decoded images shared by every process and run. Entries are keyed by the content hash of the source
+# file and the decode options, so renamed or copied sources still hit. The modification time of an entry is its last
+# use: hits touch the entry and the least recently used entries are removed once the cache is larger than maxsize.
+class ImageCache:
+    def __init__(self, directory, maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.added = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + NPY_IMAGE_EXT)
+
+    def load(self, key):
+        path = self.path(key)
         try:
-            os.makedirs(directory)
-            if verbose:
-                print("Created " + label + " directory: " + "'" + directory + "'")
-        except OSError as error:
-            if not quiet:
-                print("Failed to create " + label + " directory: '" + directory + "'")
-            return True
+            image = np.load(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # Unreadable entry, it is replaced by the next store
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return image
+
+    def store(self, key, image):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a name unique to the process and thread so concurrent stores never see partial entries
+        temppath = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+        with open(temppath, "wb") as file:
+            np.save(file, image, allow_pickle=False)
+        os.replace(temppath, path)
+        self.added += image.nbytes
+        if self.added > self.maxsize * CACHE_PRUNE_FRACTION:
+            self.prune()
+
+    # Remove the least recently used entries until the cache fits in maxsize
+    def prune(self):
+        self.added = 0
+        entries = []
+        total = 0
+        for dirpath, dirs, files in os.walk(self.directory):
+            for file in files:
+                # Entries still being written are left alone
+                if not file.endswith(NPY_IMAGE_EXT):
+                    continue
+                path = os.path.join(dirpath, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+# One cache object per process, so that every job of a worker adds to the same count of stored bytes
+@functools.lru_cache(maxsize=None)
+def opencache(directory, maxsize):
+    return ImageCache(directory, maxsize)
+
+# Fast decodes differ from regular ones and reduced scale decodes also depend on the output size
+def cachekey(digest, greyscale=False, resize=None, fast=False):
+    key = digest + ("_grey" if greyscale else "_rgb")
+    if fast:
+        key += "_fast"
+        if resize:
+            key += str(resize)
+    return key
+
+def readimage(filepath, greyscale=False):
+    from skimage import io
+    if greyscale:
+        image = io.imread(filepath, as_gray=True)
+    else:
+        image = io.imread(filepath, as_gray=False)
+    return image
+
+# Decode with Pillow straight to 8 bit greyscale or RGB values. When resizing, JPEG images are decoded at reduced scale
+# (libjpeg DCT scaling by 1/2, 1/4 or 1/8) as long as both sides stay at least 'resize' pixels. Transparent pixels are
+# blended onto white as rgba2rgb does. Returns None for images which cannot be decoded to 8 bits without loss.
+def readreduced(filepath, greyscale=False, resize=None):
+    Image = importpil()
+    with Image.open(filepath) as image:
+        if image.mode not in FAST_DECODE_MODES:
+            return None
+        # Greyscale sources stay greyscale, as with the default decoder
+        mode = "L" if greyscale or image.mode in ("1", "L", "LA") else "RGB"
+        if resize:
+            image.draft(mode, (resize, resize))
+        if image.mode in ("LA", "PA", "RGBA") or (image.mode == "P" and "transparency" in image.info):
+            image = image.convert("RGBA")
+            image = Image.alpha_composite(Image.new("RGBA", image.size, (255, 255, 255, 255)), image)
+        return np.asarray(image.convert(mode))
+
+def readanyimage(filepath, greyscale=False, resize=None, fast=False):
+    image = None
+    if fast:
+        image = readreduced(filepath, greyscale=greyscale, resize=resize)
+    if image is None:
+        image = readimage(filepath, greyscale=greyscale)
+    return image
+
+# Decode an image, or load it from the cache when given. The content hash (digest) is computed if not known yet.
+def decodeimage(filepath, greyscale=False, resize=None, fast=False, cache=None, digest=None, timings=None):
+    if cache is None:
+        with timestage(timings, "decode"):
+            return readanyimage(filepath, greyscale=greyscale, resize=resize, fast=fast)
+    if digest is None:
+        with timestage(timings, "hash"):
+            digest = hashfile(filepath)
+    key = cachekey(digest, greyscale=greyscale, resize=resize, fast=fast)
+    with timestage(timings, "cache"):
+        image = cache.load(key)
+    if image is None:
+        with timestage(timings, "decode"):
+            image = readanyimage(filepath, greyscale=greyscale, resize=resize, fast=fast)
+        with timestage(timings, "cache"):
+            cache.store(key, image)
+    return image
+
+# Scale an image for the given resize mode. Images resized with the fit mode still have to be padded to size x size.
+def resizeimage(image, size, mode="squash"):
+    import cv2
+    if mode == "squash":
+        return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+    height, width = image.shape[:2]
+    if mode == "fit":
+        scale = size / max(height, width)
     else:
-        if not quiet:
-            print("The " + label + " directory '" + directory + "' already exists.")
-        if clean:
-            return True
-    return False
-
-def iteratefilename(path, initial=0, prefix="_", suffix="", prepend=False):
-    newpath = path
-    while os.path.isfile(newpath):
-        if prepend:
-            newpath = modfilename(path, prefix=prefix+str(initial)+suffix)
+        scale = size / min(height, width)
+    width = max(1, round(width * scale))
+    height = max(1, round(height * scale))
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    if mode == "crop":
+        top = (height - size) // 2
+        left = (width - size) // 2
+        image = image[top:top + size, left:left + size]
+    return image
+
+# Pad an image with black to size x size, keeping it in the centre
+def padimage(image, size):
+    height, width = image.shape[:2]
+    top = (size - height) // 2
+    left = (size - width) // 2
+    padding = [(top, size - height - top), (left, size - width - left)] + [(0, 0)] * (image.ndim - 2)
+    return np.pad(image, padding)
+
+# Transform a decoded image to a flat image of the given size (or its own size if None)
+def transformimage(image, channels, size=None, mode="squash", float=False, floattype="float64", verbose=False, timings=None):
+    if size:
+        # Resize image
+        with timestage(timings, "resize"):
+            image = resizeimage(image, size, mode=mode)
+    # Convert image from rgba to rgb if applicable
+    if channels == 4:
+        with timestage(timings, "convert"):
+            from skimage import color
+            image = color.rgba2rgb(image)
+    # Padding is added after the conversion so that it is black for transparent images as well
+    if size and mode == "fit":
+        with timestage(timings, "resize"):
+            image = padimage(image, size)
+    # Format image as either int or float values (0-255 or 0-1)
+    with timestage(timings, "format"):
+        image = formatimage(image, float=float, floattype=floattype)
+    # Flatten image and store image shape data as meta
+    with timestage(timings, "flatten"):
+        return flatten(image, verbose=verbose)
+
+# Decode, check and transform a single image to every size in sizes (None keeps the decoded size). Returns a list of
+# (shape, flat image) with one entry per size or None if the image is useless. The time of each stage is added to
+# timings when given. Fast decodes stay 8 bit through the resize and are only converted to float values (when float is
+# set) at the end.
+def processimage(filepath, greyscale=False, sizes=[None], mode="squash", float=False, floattype="float64", minvariance=0, maxblank=0, verbose=False, timings=None, cache=None, digest=None, fast=False):
+    # Reduced scale decodes have to cover the largest size
+    resize = max(sizes) if sizes[0] else None
+    image = decodeimage(filepath, greyscale=greyscale, resize=resize, fast=fast, cache=cache, digest=digest, timings=timings)
+    # Save number of colour channels
+    channels = getchannels(image.shape)
+    # if image contains useful data
+    with timestage(timings, "useful"):
+        useful = checkuseful(image, channels, minvariance=minvariance, maxblank=maxblank, verbose=verbose)
+    if not useful:
+        return None
+    # Every size is made from the decoded image so that it matches a run for that size alone
+    return [transformimage(image, channels, size=size, mode=mode, float=float, floattype=floattype, verbose=verbose, timings=timings) for size in sizes]
+
+# Worker entry point. Returns the shape (meta) and flat image of every size as lists. When directories (one per size)
+# are given the flat images are saved under a temporary name (numbered by the job index) and their paths are returned
+# in place of the images; the parent renames them once the final index is known. Jobs reusing the output of a previous
+# run are passed straight through, new manifest records get the content hash. With timed set the stage timings of the
+# job are returned for the parent to collect. Decoded images are cached in the cache directory when given, holding at
+# most cachesize bytes.
+def processjob(job, directories=None, greyscale=False, sizes=[None], mode="squash", float=False, floattype="float64", minvariance=0, maxblank=0, compress=False, abspath=False, storage="text", codec="gzip", level=None, verbose=False, timed=False, cache=None, cachesize=0, fast=False):
+    j, filepath, labels, record, reuse = job
+    timings = {} if timed else None
+    if reuse:
+        return filepath, labels, None, None, record, reuse, timings
+    digest = None
+    if record is not None:
+        # Already hashed by the dedup stage when deduplicating
+        if record["hash"] is None:
+            with timestage(timings, "hash"):
+                record["hash"] = hashfile(filepath)
+        digest = record["hash"]
+    if cache is not None:
+        cache = opencache(cache, cachesize)
+    result = processimage(filepath, greyscale=greyscale, sizes=sizes, mode=mode, float=float, floattype=floattype, minvariance=minvariance, maxblank=maxblank, verbose=verbose, timings=timings, cache=cache, digest=digest, fast=fast)
+    if result is None:
+        return filepath, labels, None, None, record, reuse, timings
+    metas = [meta for meta, flat in result]
+    flats = [flat for meta, flat in result]
+    if directories is not None:
+        with timestage(timings, "save"):
+            flats = [saveimage(flat, TEMP_FILE_PREFIX + str(j), directory, compress=compress, abspath=abspath, storage=storage, codec=codec, level=level) for flat, directory in zip(flats, directories)]
+    return filepath, labels, metas, flats, record, reuse, timings
+
+# Attach the manifest record to each job. Unchanged files reuse the record of the previous run, all others get a new
+# record. Without a manifest there are no records.
+def planjobs(jobs, previous=None):
+    for j, filepath, labels in jobs:
+        if previous is None:
+            yield j, filepath, labels, None, False
+            continue
+        stat = os.stat(filepath)
+        record = previous.get(filepath)
+        if checkunchanged(record, filepath, stat.st_size, stat.st_mtime_ns):
+            yield j, filepath, labels, record, True
         else:
-            newpath = modfilename(path, suffix=prefix+str(initial)+suffix)
-        initial += 1
-    return newpath
+            record = {"source": filepath, "size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": None}
+            yield j, filepath, labels, record, False
 
-def exportfilelist(fileList, name, path):
-    filepath = iteratefilename(os.path.join(path, name), prefix="_")
-    try:
-        file = open(filepath, 'x')
-    except:
-        print("SOMETHING IS WRONG THIS SHOULD NEVER BE REACHED.")
-        sys.exit()
+# Index of the fingerprints of every kept file, used to find duplicates without comparing each file to every other.
+# Exact duplicates are found by content hash. Near duplicates are found through 'getkeys', which splits a fingerprint
+# into band keys such that similar fingerprints share at least one key; only files sharing a key are compared with
+# 'match'. The index is kept in memory or, given a path, in an SQLite database to bound memory on very large sources.
+class DuplicateIndex:
+    def __init__(self, getkeys=None, match=None, path=None):
+        self.getkeys = getkeys
+        self.match = match
+        self.database = None
+        self.exact = {}
+        self.buckets = {}
+        self.items = []
+        if path:
+            # The index only lives for a single run
+            if os.path.exists(path):
+                os.remove(path)
+            # Filled by the thread feeding the worker processes
+            self.database = sqlite3.connect(path, check_same_thread=False)
+            self.database.execute("PRAGMA journal_mode = OFF")
+            self.database.execute("PRAGMA synchronous = OFF")
+            self.database.execute("CREATE TABLE exact (digest TEXT PRIMARY KEY, path TEXT)")
+            self.database.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, path TEXT, fingerprint BLOB)")
+            self.database.execute("CREATE TABLE buckets (band INTEGER, key BLOB, id INTEGER)")
+            self.database.execute("CREATE INDEX bucket ON buckets (band, key)")
 
-    for ele in fileList:
-        file.write(ele + "\n")
+    # Path of the first file with the same content or a matching fingerprint, None if there is none
+    def find(self, digest, fingerprint=None):
+        if self.database:
+            row = self.database.execute("SELECT path FROM exact WHERE digest = ?", (digest,)).fetchone()
+            if row:
+                return row[0]
+        elif digest in self.exact:
+            return self.exact[digest]
+        if fingerprint is None or self.getkeys is None:
+            return None
+        checked = set()
+        for band, key in enumerate(self.getkeys(fingerprint)):
+            if self.database:
+                candidates = self.database.execute("SELECT items.id, items.path, items.fingerprint FROM buckets JOIN items ON buckets.id = items.id WHERE buckets.band = ? AND buckets.key = ?", (band, key))
+            else:
+                candidates = ((id,) + self.items[id] for id in self.buckets.get((band, key), []))
+            for id, path, other in candidates:
+                if id in checked:
+                    continue
+                checked.add(id)
+                if self.match(fingerprint, other):
+                    return path
+        return None
 
+    def add(self, digest, path, fingerprint=None):
+        if self.database:
+            self.database.execute("INSERT OR IGNORE INTO exact VALUES (?, ?)", (digest, path))
+        else:
+            self.exact.setdefault(digest, path)
+        if fingerprint is None or self.getkeys is None:
+            return
+        if self.database:
+            id = self.database.execute("INSERT INTO items (path, fingerprint) VALUES (?, ?)", (path, fingerprint)).lastrowid
+            self.database.executemany("INSERT INTO buckets VALUES (?, ?, ?)", [(band, key, id) for band, key in enumerate(self.getkeys(fingerprint))])
+        else:
+            id = len(self.items)
+            self.items.append((path, fingerprint))
+            for band, key in enumerate(self.getkeys(fingerprint)):
+                self.buckets.setdefault((band, key), []).append(id)
+
+    def close(self):
+        if self.database:
+            self.database.close()
+            self.database = None
+
+# Greyscale thumbnail (size x size) of an image for perceptual hashing. JPEG images are decoded at reduced scale.
+def readthumbnail(filepath, size):
+    import cv2
+    Image = importpil()
+    if Image is not None:
+        with Image.open(filepath) as image:
+            image.draft("L", (size, size))
+            image = np.asarray(image.convert("L"), dtype=np.float32)
+    else:
+        image = readimage(filepath, greyscale=True).astype(np.float32)
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+
+# Perceptual hash of an image as HASH_BITS bits. ahash: pixels of an 8 x 8 thumbnail above their mean. phash: lowest
+# 8 x 8 frequencies of the DCT of a 32 x 32 thumbnail above their median (leaving out the DC term).
+def hashimage(filepath, method="phash"):
+    if method == "ahash":
+        pixels = readthumbnail(filepath, 8).flatten()
+        bits = pixels > pixels.mean()
+    else:
+        import cv2
+        frequencies = cv2.dct(readthumbnail(filepath, 32))[:8, :8].flatten()
+        bits = frequencies > np.median(frequencies[1:])
+    return np.packbits(bits).tobytes()
+
+# Split a perceptual hash into distance + 1 bands. Hashes differing in at most distance bits have at least one equal
+# band, so only hashes sharing a band have to be compared.
+def hashbands(fingerprint, distance=HASH_DISTANCE):
+    value = int.from_bytes(fingerprint, "big")
+    bands = distance + 1
+    keys = []
+    for band in range(bands):
+        start = HASH_BITS * band // bands
+        end = HASH_BITS * (band + 1) // bands
+        keys.append(((value >> (HASH_BITS - end)) & ((1 << (end - start)) - 1)).to_bytes(HASH_BITS // 8, "big"))
+    return keys
+
+def matchhash(fingerprint, other, distance=HASH_DISTANCE):
+    return bin(int.from_bytes(fingerprint, "big") ^ int.from_bytes(other, "big")).count("1") <= distance
+
+# Worker entry point of the dedup stage. Returns the job with the content hash and, for perceptual methods, the
+# perceptual hash of its file. Unchanged files reuse the fingerprint of the previous run and the content hash of new
+# manifest records is kept so it is not computed again.
+def fingerprintjob(job, method="exact", timed=False):
+    j, filepath, labels, record, reuse = job
+    timings = {} if timed else None
+    if reuse and record.get("fingerprint"):
+        digest, fingerprint = record["fingerprint"]
+        return job, digest, bytes.fromhex(fingerprint) if fingerprint else None, timings
+    with timestage(timings, "hash"):
+        digest = hashfile(filepath)
+    if record is not None and not reuse:
+        record["hash"] = digest
+    fingerprint = None
+    if method != "exact":
+        with timestage(timings, "fingerprint"):
+            fingerprint = hashimage(filepath, method=method)
+    return job, digest, fingerprint, timings
+
+# Drop the jobs of duplicate files, keeping the first file (in walk order) of every group of duplicates. Duplicates
+# are listed in the duplicates file along with the file they duplicate. Kept jobs store their fingerprint in their
+# manifest record so unchanged files are not fingerprinted again.
+def dedupjobs(results, index, duplicates, stats=None):
+    lines = csv.writer(duplicates, lineterminator="\n")
+    for job, digest, fingerprint, timings in results:
+        j, filepath, labels, record, reuse = job
+        with timestage(timings, "dedup"):
+            original = index.find(digest, fingerprint)
+            if original is None:
+                index.add(digest, filepath, fingerprint)
+        if stats and timings:
+            stats.add(timings)
+        if original is not None:
+            lines.writerow([filepath, original])
+            if stats:
+                stats.count("duplicate")
+            continue
+        if record is not None:
+            record["fingerprint"] = [digest, fingerprint.hex() if fingerprint else None]
+        yield job
+
+def formatmeta(labels, shape, imagepath, format="int"):
+    # labels: num labels followed by each label
+    line = str(len(labels)) + " "
+    for label in labels:
+        label = "_".join(label.split())
+        line += str(label) + " "
+    # shape data
+    shapelen = getchannels(shape)
+    if shapelen == 1:
+        shapelen = 2
+    line += str(shapelen) + " "
+    for i in range(shapelen):
+        line += str(shape[i]) + " "
+    # format of image values (int or float for text files, dtype name for binary files)
+    line += format + " "
+    # path to the flattened image file (.csv, .npy or shard locator)
+    return line + imagepath + "\n"
+
+def exportmeta(data, path, format="int"):
+    file = openrecords(METADATA_FILENAME, path)
+    for image in data:
+        labels, shape, imagepath = image
+        file.write(formatmeta(labels, shape, imagepath, format=format))
     file.close()
 
+def hashfile(filepath):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as file:
+        for chunk in iter(functools.partial(file.read, HASH_CHUNKSIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Load the manifest records of previous runs keyed by source path. Later records replace earlier ones for the same
+# source. Records written by a run with different output options cannot be reused and are discarded.
+def loadmanifest(filepath, options, verbose=False, quiet=False):
+    records = {}
+    if not os.path.isfile(filepath):
+        return records
+    with open(filepath, "r") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partially written record at the end of a crashed run
+                continue
+            if "options" in record:
+                if record["options"] != options:
+                    if not quiet:
+                        print("The manifest was created with different options. All files will be processed again.")
+                    return {}
+            else:
+                records[record["source"]] = record
+    if verbose:
+        print("Loaded " + str(len(records)) + " records from the manifest.")
+    return records
+
+# Rewrite the manifest with only the given records. The file is replaced atomically.
+def writemanifest(filepath, records, options):
+    temppath = filepath + ".tmp"
+    with open(temppath, "w") as file:
+        file.write(json.dumps({"options": options}) + "\n")
+        for record in records.values():
+            file.write(json.dumps(record) + "\n")
+    os.replace(temppath, filepath)
+
+# Check if the output of a previous run can be reused for the source file. Only the size and modification time are
+# compared unless the modification time changed, in which case the contents are hashed.
+def checkunchanged(record, filepath, size, mtime):
+    if record is None or record["size"] != size:
+        return False
+    if record["mtime"] != mtime:
+        if hashfile(filepath) != record["hash"]:
+            return False
+        record["mtime"] = mtime
+    if record["useful"] and not all(checkoutput(output) for output in record["output"]):
+        return False
+    return True
+
 def main():
     parser = argparse.ArgumentParser(description="Do preprocessing on image data for supervised learning tasks. Take image files from source directories and perform preprocessing operation on each image. By default images will be converted to RGB format. The directory tree determines the data labels such that each folder name is a label for all images held within itself and its subdirectories. Whitespace in labels will be replaced with underscores. Export each image as a flat file to the target directory along with a single metadata file 'metadata.csv' holding the labels, image shape data, value format of flattened image, and the path to the flattened image file. Images that are unlabeled will have their paths exported to a file 'unlabeled.csv' in the same directory as the metadata file. Images that contain useless data will have their paths exported to a file 'useless.csv' in the same directory as the metadata file.")
     parser.add_argument("target", type=str, help="Path to the target directory where all processed data output files will be stored.")
     parser.add_argument("-m", "--metadata", type=str, help="Optional path to the metadata file. If unset then metadata file will be stored in the target directory.")
     parser.add_argument("-s", "--source", action="append", type=str, help="Path to the source directory holding image files to be processed. The folder names of the directory tree determines the labels for each image. Each extra argument will add another source directory to the list of directories.")
     parser.add_argument("-r", "--root", action="store_true", help="Do not ignore the root directory name in the labeling process for each source file.")
-    parser.add_argument("-c", "--compress", action="store_true", help="Compress each output file using GNU zip (.gz).")
+    parser.add_argument("-c", "--compress", action="store_true", help="Compress each output file as it is written. Uses GNU zip (.gz) unless another codec is chosen.")
+    parser.add_argument("--codec", choices=COMPRESSION_CODECS, default="gzip", help="Compression codec used with --compress. zstd and lz4 require the zstandard and lz4 packages.")
+    parser.add_argument("--level", type=int, help="Compression level used with --compress. Defaults to a fast level for the chosen codec.")
+    parser.add_argument("--writers", type=int, default=2, help="Number of background threads compressing and writing (or renaming the worker output to) output files.")
+    parser.add_argument("--writequeue", type=int, default=WRITER_PENDING, help="Maximum number of output files waiting for the writer threads. Processing is held back while the queue is full, which caps the memory held by pending output.")
+    parser.add_argument("--fsync", type=int, default=0, help="Sync output files to stable storage in batches of the given number of files (shards are synced as they are flushed). By default outputs are left to the operating system to write back.")
     parser.add_argument("-g", "--greyscale", action="store_true", help="Convert images to greyscale.")
     parser.add_argument("-f", "--float", action="store_true", help="Store values as floats (0-1) instead of unsigned integers (0-255).")
+    parser.add_argument("--floattype", choices=FLOAT_TYPES, default="float64", help="Type of the float values stored with --float. float32 and float16 halve and quarter the size of binary files at a relative precision of about 1e-7 and 5e-4. uint8 stores values quantized to 256 levels, a quarter of float32, with the scale and offset restoring them (to within 0.002) recorded in the value format of the metadata.")
     parser.add_argument("-o", "--override", action="store_true", help="Allows for the target directory to be an existing directory and will override any existing files if collision occurs during export.")
+    parser.add_argument("-u", "--incremental", action="store_true", help="Keep a manifest of every source file (size, modification time and content hash) and its output in the metadata directory. Later runs into the same target only process new or modified files, remove the output of deleted files and resume a crashed run. Requires the same output options as the previous run.")
     parser.add_argument("-a", "--abspath", action="store_true", help="Force absolute path names.")
-    parser.add_argument("-e", "--resize", type=int, help="Resize and rescale the images such that the resolution becomes m x m where m is the value given.")
+    parser.add_argument("-e", "--resize", type=int, action="append", help="Resize and rescale the images such that the resolution becomes m x m where m is the value given. Repeat the option (-e 64 -e 32) to export every size from a single decode of each image. Each size is then stored in its own subdirectory (named after the size) of the target and metadata directories, with its own metadata file and the same index for the same source image.")
+    parser.add_argument("--resizemode", choices=RESIZE_MODES, default="squash", help="How images are resized: stretched to m x m (squash), scaled to fit within m x m and padded with black (fit), scaled to cover m x m and cropped to the centre (crop), or scaled such that the shorter side becomes m keeping the aspect ratio (short).")
+    parser.add_argument("--fastdecode", action="store_true", help="Decode images with Pillow straight to 8 bit values which are only converted to float at the end. When resizing, JPEG images are decoded at a reduced scale close to the output size, which is much faster for large photographs. Values differ slightly from the default decoder.")
+    parser.add_argument("--minvariance", type=float, default=0, help="Minimum variance of the pixel values (scaled to 0-1) for an image to be considered useful data.")
+    parser.add_argument("--maxblank", type=float, default=0, help="Maximum fraction (0-1) of black or white pixels for an image to be considered useful data.")
+    parser.add_argument("--cache", type=str, help="Directory of a cache of decoded images shared between runs. Images already in the cache (by file content) are loaded from it instead of being decoded again, which speeds up reruns of the same source with other resize, float or storage options.")
+    parser.add_argument("--cachesize", type=int, default=4096, help="Maximum size of the decoded image cache in megabytes. The least recently used images are removed once it is exceeded.")
+    parser.add_argument("--dedup", choices=DEDUP_METHODS, help="Skip duplicate images before they are transformed and saved, keeping the first of every group of duplicates. Duplicates are found by identical file content (exact) and optionally by perceptual hashes within --hashdistance bits (ahash: average hash, phash: DCT hash). Duplicates are listed along with the image they duplicate in the file 'duplicates.csv' in the same directory as the metadata file.")
+    parser.add_argument("--hashdistance", type=int, default=HASH_DISTANCE, help="Maximum number of differing bits (out of 64) between the perceptual hashes of near duplicate images.")
+    parser.add_argument("--dedupindex", type=str, help="Path to an SQLite database holding the dedup index instead of memory, for sources of many millions of images. The database is replaced on every run.")
+    parser.add_argument("--storage", choices=STORAGE_TYPES, default="text", help="Output storage of the flattened images: one text file per image (text), one binary NumPy file per image (npy), or raw binary shards holding many images (shard). Binary images can be memory mapped on read.")
+    parser.add_argument("--shardsize", type=int, default=1024, help="Maximum size of each shard file in megabytes when using shard storage.")
+    parser.add_argument("--scanthreads", type=int, default=SCAN_THREADS, help="Number of threads listing source directories ahead of processing.")
+    parser.add_argument("--metabatch", type=int, default=METADATA_BATCHSIZE, help="Number of metadata, unlabeled and useless records buffered before they are written to disk.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes used to decode, transform and save images. Output indices and metadata are identical to a single process run.")
+    parser.add_argument("--stats", type=str, help="Path to a JSON file in which the number of files, throughput and the cumulative time and duration histogram of every pipeline stage are stored at the end of the run.")
+    parser.add_argument("--progress", type=float, default=0, help="Print a progress line at most once every given number of seconds instead of a line for every file.")
+    parser.add_argument("--profile", type=str, help="Profile the main process with cProfile and store the statistics in the given file.")
+    parser.add_argument("--tracemalloc", type=int, default=0, help="Trace memory allocations of the main process and add the given number of largest allocation sites to the stats file.")
     log_group = parser.add_mutually_exclusive_group()
     log_group.add_argument("-v", "--verbose", action="store_true", help="Output actions to the console and show detailed information.")
     log_group.add_argument("-q", "--quiet", action="store_true", help="Suppress ouptut to the console.")
 
     args = parser.parse_args()
 
-    if createdir(args.target, label="target", clean=(not args.override), verbose=args.verbose, quiet=args.quiet):
+    if createdir(args.target, label="target", clean=(not args.override and not args.incremental), verbose=args.verbose, quiet=args.quiet):
         sys.exit()
     if checkdirs(args.source, label="source", verbose=args.verbose, quiet=args.quiet):
         sys.exit()
@@ -208,75 +911,238 @@ def main():
         if createdir(args.metadata, label="metadata", clean=False, verbose=args.verbose, quiet=args.quiet):
             sys.exit()
 
+    if args.workers < 1:
+        if not args.quiet:
+            print("Number of workers must be at least 1.")
+        sys.exit()
+    if args.compress and args.storage == "shard":
+        if not args.quiet:
+            print("Compression is not supported for shard storage.")
+        sys.exit()
+    if args.compress and not checkcodec(args.codec):
+        if not args.quiet:
+            print("The package required for the " + args.codec + " codec is not installed.")
+        sys.exit()
+    if args.writers < 1 or args.writequeue < 1:
+        if not args.quiet:
+            print("Number of writers and size of the write queue must be at least 1.")
+        sys.exit()
+    if args.fastdecode and importpil() is None:
+        if not args.quiet:
+            print("The Pillow package is required for fast decoding.")
+        sys.exit()
+    if args.cache and args.cachesize < 1:
+        if not args.quiet:
+            print("Size of the cache must be at least 1 megabyte.")
+        sys.exit()
+    if args.fsync < 0:
+        if not args.quiet:
+            print("Number of files per sync must not be negative.")
+        sys.exit()
+    if args.hashdistance < 0 or args.hashdistance >= HASH_BITS // 2:
+        if not args.quiet:
+            print("Hash distance must be at least 0 and less than " + str(HASH_BITS // 2) + ".")
+        sys.exit()
+    if args.floattype != "float64" and not args.float:
+        if not args.quiet:
+            print("A float type can only be given with --float.")
+        sys.exit()
+    if args.resize and (min(args.resize) < 1 or len(set(args.resize)) != len(args.resize)):
+        if not args.quiet:
+            print("Resize values must be positive and distinct.")
+        sys.exit()
+
     if not args.quiet:
         print("Starting operation...")
 
-    data = []
-    unlabeled = []
-    useless = []
+    profiler = startprofile(profile=args.profile, tracemem=args.tracemalloc)
+    stats = Stats(interval=args.progress, quiet=args.quiet)
+    timings = {} if args.stats else None
+
+    # Metadata and file lists are streamed to disk while the images are processed. Incremental runs rewrite them
+    # in full as every source file is listed again.
+    metapath = args.metadata if args.metadata else args.target
+    sizes = args.resize if args.resize else [None]
+    targets = sizedirs(args.target, sizes)
+    for target in targets + sizedirs(metapath, sizes):
+        os.makedirs(target, exist_ok=True)
+    data = [openrecords(METADATA_FILENAME, path, batchsize=args.metabatch, overwrite=args.incremental) for path in sizedirs(metapath, sizes)]
+    unlabeled = openrecords(UNLABELED_FILENAME, metapath, batchsize=args.metabatch, overwrite=args.incremental)
+    useless = openrecords(USELESS_FILENAME, metapath, batchsize=args.metabatch, overwrite=args.incremental)
+    duplicates = None
+    dedupindex = None
+    if args.dedup:
+        duplicates = openrecords(DUPLICATES_FILENAME, metapath, batchsize=args.metabatch, overwrite=args.incremental)
+        if args.dedup == "exact":
+            dedupindex = DuplicateIndex(path=args.dedupindex)
+        else:
+            dedupindex = DuplicateIndex(getkeys=functools.partial(hashbands, distance=args.hashdistance), match=functools.partial(matchhash, distance=args.hashdistance), path=args.dedupindex)
+    format = dataformat(float=args.float, storage=args.storage, floattype=args.floattype)
+    cachesize = args.cachesize * 1024 * 1024
+    if args.cache:
+        # Apply a smaller maximum size to the entries of earlier runs before adding new ones
+        opencache(args.cache, cachesize).prune()
+    pool = None
+    fingerprinter = None
+    shards = []
+    writer = None
+    manifest = None
+    previous = None
+    records = {}
     i = 0
-    for source in args.source:
-        for root, dirs, files in os.walk(source):
-            for file in files:
-                filepath = os.path.join(root, file)
-                if args.abspath:
-                    filepath = os.path.abspath(filepath)
-                if not args.quiet:
-                    print("Currently processing image: " + file)
-                elif args.verbose:
-                    print("Currently processing image: " + filepath)
-                labelpath = root
-                if not args.root:
-                    labelpath = removeaffix(root, prefix=source)
-                labels = getlabels(trimpathsep(labelpath), verbose=args.verbose)
-                # If data is labeled
-                if labels[0]:
-                    # Get image file ready
-                    if args.greyscale:
-                        image = io.imread(filepath, as_gray=True)
-                    else:
-                        image = io.imread(filepath, as_gray=False)
-
-                    if args.resize:
-                        # Resize image
-                        image = cv2.resize(image, (args.resize, args.resize), interpolation=cv2.INTER_AREA)
-
-                    # Save number of colour channels
-                    channels = getchannels(image.shape)
-                    # Convert image from rgba to rgb if applicable
-                    if channels == 4:
-                        image = color.rgba2rgb(image)
-                        channels = 3
-                    # if image contains useful data
-                    if checkuseful(image, channels, verbose=args.verbose):
-                        # Format image as either int or float values (0-255 or 0-1)
-                        image = formatimage(image, float=args.float)
-                        # Flatten image and store image shape data as meta
-                        meta, flat = flatten(image, verbose=args.verbose)
-                        # Save flat image to csv file
-                        flatpath = saveimage(flat, str(i), args.target, float=args.float, compress=args.compress, abspath=args.abspath)
-                        i += 1
-                        data.append([labels, meta, flatpath])
-                    else:
-                        useless.append(filepath)
-
-                # Else, data is not labeled
+    if args.incremental:
+        options = {"target": args.target, "root": args.root, "abspath": args.abspath, "greyscale": args.greyscale, "float": args.float, "floattype": args.floattype, "resize": args.resize, "resizemode": args.resizemode, "fastdecode": args.fastdecode, "minvariance": args.minvariance, "maxblank": args.maxblank, "dedup": args.dedup, "hashdistance": args.hashdistance, "storage": args.storage, "compress": args.compress, "codec": args.codec}
+        manifestpath = os.path.join(metapath, MANIFEST_FILENAME)
+        previous = loadmanifest(manifestpath, options, verbose=args.verbose, quiet=args.quiet)
+        indices = [record["index"] for record in previous.values() if record["index"] is not None]
+        if indices:
+            i = max(indices) + 1
+        writemanifest(manifestpath, previous, options)
+
+        # A manifest record is only committed once the output it refers to has been written
+        def commit():
+            if writer:
+                writer.drain()
+            for shard in shards:
+                shard.flush()
+
+        manifest = RecordWriter(manifestpath, batchsize=args.metabatch, mode='a', beforeflush=commit)
+    try:
+        if args.storage == "shard":
+            shards = [ShardWriter(target, args.shardsize * 1024 * 1024, abspath=args.abspath, fsync=args.fsync > 0) for target in targets]
+        jobs = walkfiles(args.source, unlabeled, root=args.root, abspath=args.abspath, verbose=args.verbose, quiet=args.quiet, stats=stats, progress=bool(args.progress), threads=args.scanthreads)
+        jobs = planjobs(jobs, previous)
+        if not shards:
+            # Writes (or the renames of worker output) overlap with processing of the following files
+            writer = BackgroundWriter(args.writers, pending=args.writequeue, fsync=args.fsync)
+        if args.workers > 1:
+            pool = multiprocessing.Pool(args.workers)
+        if args.dedup:
+            fingerprint = functools.partial(fingerprintjob, method=args.dedup, timed=bool(args.stats))
+            if pool:
+                # Fingerprints are computed by a pool of their own. dedupjobs runs on the task thread of the processing
+                # pool, which would never get to submit fingerprint tasks to its own pool while waiting for them.
+                # The window keeps the walk from being drained ahead of the processing. Its workers ignore SIGINT so
+                # that the fingerprints waited for still arrive when an interrupted run shuts the processing pool down.
+                fingerprinter = multiprocessing.Pool(args.workers, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+                jobs = dedupjobs(imapwindow(fingerprinter, fingerprint, jobs, FINGERPRINT_WINDOW * args.workers, chunksize=WORKER_CHUNKSIZE), dedupindex, duplicates, stats=stats)
+            else:
+                jobs = dedupjobs(map(fingerprint, jobs), dedupindex, duplicates, stats=stats)
+        if pool:
+            # Shards are appended to by the parent only, so workers hand back the flat image instead of saving it
+            directories = None if shards else targets
+            job = functools.partial(processjob, directories=directories, greyscale=args.greyscale, sizes=sizes, mode=args.resizemode, float=args.float, floattype=args.floattype, minvariance=args.minvariance, maxblank=args.maxblank, compress=args.compress, abspath=args.abspath, storage=args.storage, codec=args.codec, level=args.level, verbose=args.verbose, timed=bool(args.stats), cache=args.cache, cachesize=cachesize, fast=args.fastdecode)
+            # imap returns results in submission order which keeps the output indices deterministic
+            results = pool.imap(job, jobs, chunksize=WORKER_CHUNKSIZE)
+        else:
+            job = functools.partial(processjob, greyscale=args.greyscale, sizes=sizes, mode=args.resizemode, float=args.float, floattype=args.floattype, minvariance=args.minvariance, maxblank=args.maxblank, verbose=args.verbose, timed=bool(args.stats), cache=args.cache, cachesize=cachesize, fast=args.fastdecode)
+            results = map(job, jobs)
+
+        for filepath, labels, metas, flats, record, reuse, jobtimings in results:
+            stats.count("processed")
+            stats.progress()
+            if jobtimings:
+                stats.add(jobtimings)
+            if reuse:
+                # Unchanged since the previous run
+                stats.count("reused")
+                records[filepath] = record
+                if record["useful"]:
+                    for k in range(len(sizes)):
+                        data[k].write(formatmeta(labels, record["meta"][k], record["output"][k], format=format))
                 else:
-                    if args.verbose:
-                        print("Current image is unlabeled. Image will be ignored.")
-                    unlabeled.append(filepath)
+                    useless.write(filepath + "\n")
+                continue
+            old = previous.get(filepath) if previous else None
+            flatpaths = None
+            # if image contains useful data
+            if metas is not None:
+                # Modified files keep the index of their previous output
+                if old is not None and old["index"] is not None:
+                    index = old["index"]
+                else:
+                    index = i
+                    i += 1
+                flatpaths = []
+                for k, flat in enumerate(flats):
+                    # Files saved by the workers only have to be renamed by the main process
+                    with timestage(timings, "rename" if pool and not shards else "save"):
+                        if shards:
+                            flatpath = shards[k].write(flat)
+                        else:
+                            flatpath = outputpath(str(index), targets[k], compress=args.compress, abspath=args.abspath, storage=args.storage, codec=args.codec)
+                            if pool:
+                                # Move the flat image saved by the worker to its final index
+                                writer.submit(flatpath, os.replace, flat, flatpath)
+                            else:
+                                # Save flat image to file
+                                writer.submit(flatpath, writeimage, flat, flatpath, compress=args.compress, storage=args.storage, codec=args.codec, level=args.level)
+                    with timestage(timings, "export"):
+                        data[k].write(formatmeta(labels, metas[k], flatpath, format=format))
+                    flatpaths.append(flatpath)
+                stats.count("useful")
+            else:
+                useless.write(filepath + "\n")
+                stats.count("useless")
+            if record is not None:
+                if old is not None and old["useful"]:
+                    for output in old["output"]:
+                        if flatpaths is None or output not in flatpaths:
+                            removeoutput(output)
+                record["useful"] = metas is not None
+                record["index"] = index if metas is not None else None
+                record["output"] = flatpaths
+                record["meta"] = [list(meta) for meta in metas] if metas is not None else None
+                records[filepath] = record
+                manifest.write(json.dumps(record) + "\n")
+            if timings:
+                stats.add(timings)
+                timings.clear()
 
-    if args.verbose:
-        print("Finished processing images. Now exporting metadata...")
+        if pool:
+            pool.close()
+            pool.join()
+        if fingerprinter:
+            fingerprinter.close()
+            fingerprinter.join()
 
-    if args.metadata:
-        exportmeta(data, args.metadata, float=args.float)
-        exportfilelist(unlabeled, UNLABELED_FILENAME, args.metadata)
-        exportfilelist(useless, USELESS_FILENAME, args.metadata)
-    else:
-        exportmeta(data, args.target, float=args.float)
-        exportfilelist(unlabeled, UNLABELED_FILENAME, args.target)
-        exportfilelist(useless, USELESS_FILENAME, args.target)
+        if args.verbose:
+            print("Finished processing images. Now exporting metadata...")
+    finally:
+        # Flush everything processed so far, even if the run was interrupted
+        # The task thread of the processing pool may be waiting for a fingerprint, so it is stopped first
+        if pool:
+            pool.terminate()
+        if fingerprinter:
+            fingerprinter.terminate()
+        if manifest:
+            manifest.close()
+        for shard in shards:
+            shard.close()
+        if writer:
+            writer.close()
+        for metadata in data:
+            metadata.close()
+        unlabeled.close()
+        useless.close()
+        if duplicates:
+            duplicates.close()
+        if dedupindex:
+            dedupindex.close()
+
+    if manifest:
+        # Drop the output of source files which no longer exist and compact the manifest
+        for source, record in previous.items():
+            if source not in records and record["useful"]:
+                if args.verbose:
+                    print("Removing output of deleted or duplicate file: " + source)
+                for output in record["output"]:
+                    removeoutput(output)
+        writemanifest(manifestpath, records, options)
+
+    extra = stopprofile(profiler, profile=args.profile, tracemem=args.tracemalloc)
+    if args.stats:
+        stats.export(args.stats, extra=extra)
 
     if not args.quiet:
         print("Finished operation.")
@@ -0,0 +1,409 @@
+import os
+import sys
+import io
+import gzip
+import json
+import time
+import contextlib
+import threading
+import concurrent.futures
+import functools
+import collections
+import itertools
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+# Helpers shared by clean_image.py, ingress_image.py and inspect_image.py. Only the standard library is imported here
+# (and the optional codecs) so tools which never decode an image start quickly; image libraries are imported by the
+# functions that use them.
+
+NPY_IMAGE_EXT = ".npy"
+# Images stored in a shard are located by "<shard path>@<byte offset>"
+SHARD_OFFSET_SEP = "@"
+COMPRESSION_CODECS = ["gzip", "zstd", "lz4"]
+CODEC_EXTS = {"gzip": ".gz", "zstd": ".zst", "lz4": ".lz4"}
+CODEC_LEVELS = {"gzip": 6, "zstd": 3, "lz4": 0}
+# Leading bytes (magic numbers) of each compressed stream used to detect the codec on read
+CODEC_MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd", "lz4": b"\x04\x22\x4d\x18"}
+METADATA_BATCHSIZE = 1000
+# Threads listing directories and the number of directories listed ahead of the walk
+SCAN_THREADS = 4
+SCAN_WINDOW = 64
+# Number of power of two buckets (in microseconds) of the stage duration histograms
+HISTOGRAM_BUCKETS = 40
+# Float values (0-1) stored as uint8 are restored as value * QUANTIZE_SCALE + QUANTIZE_OFFSET. The value format of
+# quantized images is "<type>:<scale>:<offset>".
+QUANTIZE_SCALE = 1 / 255
+QUANTIZE_OFFSET = 0.0
+QUANTIZE_SEP = ":"
+
+
+# PIL is optional and only imported once it is needed. Returns the PIL Image module or None if PIL is not installed.
+@functools.lru_cache(maxsize=None)
+def importpil():
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+def quantformat(dtype, scale, offset):
+    return dtype + QUANTIZE_SEP + repr(scale) + QUANTIZE_SEP + repr(offset)
+
+# Split a value format of the metadata into the stored type and the scale and offset of quantized values (None for
+# values stored as they are)
+def parseformat(format):
+    dtype, sep, quantization = format.partition(QUANTIZE_SEP)
+    if not sep:
+        return format, None, None
+    scale, offset = quantization.split(QUANTIZE_SEP)
+    return dtype, float(scale), float(offset)
+
+def removeaffix(string, prefix=None, suffix=None):
+    if prefix:
+        try:
+            string = string.removeprefix(prefix)
+        except:
+            if string.startswith(prefix):
+                string = string[len(prefix):]
+    if suffix:
+        try:
+            string = string.removesuffix(suffix)
+        except:
+            if string.endswith(suffix):
+                string = string[:-len(suffix)]
+    return string
+
+def trimpathsep(path, leading=True, trailing=True):
+    if leading and trailing:
+        return path.strip(os.sep)
+    elif leading:
+        return path.lstrip(os.sep)
+    elif trailing:
+        return path.rstrip(os.sep)
+
+def checkdirs(dirs, label="", verbose=False, quiet=False):
+    invalid = False
+    for dir in dirs:
+        invalid = checkdir(dir, label=label, verbose=verbose, quiet=quiet)
+        if invalid and not verbose:
+            return invalid
+    return invalid
+
+def checkdir(directory, label="", verbose=False, quiet=False):
+    if not os.path.isdir(directory):
+        if verbose:
+            print("The " + label + " directory: '" + dir + "'" + " does not exist.")
+        elif not quiet:
+            print("Some " + label + " path(s) are invalid.")
+        return True
+    return False
+
+def modfilename(path, prefix="", suffix=""):
+    root, file = os.path.split(path)
+    file, ext = os.path.splitext(file)
+    file = prefix + file + suffix
+    return os.path.join(root, file + ext)
+
+def getlabels(path, delimiter=os.sep, verbose=False):
+    labels = path.split(delimiter)
+    if verbose:
+        if labels[0]:
+            print("The labels for image are: " + str(labels))
+    return labels
+
+def checkcodec(codec):
+    if codec == "zstd" and zstandard is None:
+        return False
+    if codec == "lz4" and lz4frame is None:
+        return False
+    return True
+
+def codecext(codec):
+    return CODEC_EXTS[codec]
+
+# Open a binary stream which compresses everything written to it
+def opencompressed(filepath, codec="gzip", level=None):
+    if level is None:
+        level = CODEC_LEVELS[codec]
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(filepath, "wb"), closefd=True)
+    if codec == "lz4":
+        return lz4frame.LZ4FrameFile(filepath, "wb", compression_level=level)
+    return gzip.GzipFile(filepath, "wb", compresslevel=level)
+
+def detectcodec(magic):
+    for codec, codecmagic in CODEC_MAGIC.items():
+        if magic.startswith(codecmagic):
+            return codec
+    return None
+
+# Open a binary stream of the file contents, decompressing on the fly if the file starts with a known codec header
+def openinput(filepath):
+    file = open(filepath, "rb")
+    codec = detectcodec(file.peek(4)[:4])
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=file, mode="rb")
+    if codec == "zstd":
+        if zstandard is None:
+            file.close()
+            raise ImportError("The zstandard package is required to read '" + filepath + "'.")
+        # Buffered so that the stream can be iterated line by line like the gzip and lz4 files
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(file, closefd=True))
+    if codec == "lz4":
+        if lz4frame is None:
+            file.close()
+            raise ImportError("The lz4 package is required to read '" + filepath + "'.")
+        return lz4frame.LZ4FrameFile(file, "rb")
+    return file
+
+def splitlocator(path):
+    shardpath, sep, offset = path.rpartition(SHARD_OFFSET_SEP)
+    if sep and offset.isdigit():
+        return shardpath, int(offset)
+    return path, None
+
+# Add the time spent in the block to timings[stage]. Does nothing when timings is None.
+@contextlib.contextmanager
+def timestage(timings, stage):
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+# Time every step of an iterator (e.g. a directory walk) as the given stage
+def timeiter(iterable, timings, stage):
+    iterator = iter(iterable)
+    while True:
+        with timestage(timings, stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+# Collects the timings of every pipeline stage: the number of timed calls, the cumulative and longest duration and a
+# histogram of durations in power of two buckets of microseconds. Also counts files and prints a progress line at
+# most once every 'interval' seconds.
+class Stats:
+    def __init__(self, interval=0, quiet=False):
+        self.stages = {}
+        self.counts = {}
+        self.interval = interval
+        self.quiet = quiet
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def add(self, timings):
+        with self.lock:
+            for stage, seconds in timings.items():
+                if stage not in self.stages:
+                    self.stages[stage] = [0, 0.0, 0.0, [0] * HISTOGRAM_BUCKETS]
+                entry = self.stages[stage]
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+                entry[3][min(int(seconds * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def progress(self):
+        if not self.interval or self.quiet:
+            return
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            processed = self.counts.get("processed", 0)
+            print("Processed " + str(processed) + " files in " + str(round(now - self.start, 1)) + " seconds (" + str(round(processed / (now - self.start), 1)) + " files/s).")
+
+    def export(self, filepath, extra=None):
+        elapsed = time.perf_counter() - self.start
+        stages = {}
+        for stage, (count, total, longest, histogram) in self.stages.items():
+            buckets = {}
+            for bucket, amount in enumerate(histogram):
+                if amount:
+                    buckets["<" + str(2 ** bucket) + "us"] = amount
+            stages[stage] = {"count": count, "total_seconds": total, "mean_seconds": total / count, "max_seconds": longest, "histogram": buckets}
+        stats = {"elapsed_seconds": elapsed, "counts": self.counts, "files_per_second": self.counts.get("processed", 0) / elapsed, "stages": stages}
+        if extra:
+            stats.update(extra)
+        with open(filepath, "w") as file:
+            json.dump(stats, file, indent=2)
+
+# List a directory once, splitting its entries into subdirectories to walk and file names. Symbolic links to
+# directories are not walked, as with os.walk. Returns None if the directory cannot be read.
+def listdir(path):
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    isdir = entry.is_dir()
+                except OSError:
+                    isdir = False
+                if not isdir:
+                    files.append(entry.name)
+                elif not entry.is_symlink():
+                    dirs.append(entry.path)
+    except OSError:
+        return None
+    return dirs, files
+
+# Walk a directory tree in the same (top down) order as os.walk, yielding (directory, file names). The next 'window'
+# directories to be visited are listed ahead of time by a pool of threads, so that processing of the first
+# directories overlaps with the listing of the rest of the tree and slow (networked) listings run concurrently.
+def scantree(source, threads=SCAN_THREADS, window=SCAN_WINDOW):
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        # Directories still to visit, the next one to visit is last
+        stack = [[source, None]]
+        while stack:
+            for entry in stack[-window:]:
+                if entry[1] is None:
+                    entry[1] = executor.submit(listdir, entry[0])
+            path, future = stack.pop()
+            listing = future.result()
+            if listing is None:
+                continue
+            dirs, files = listing
+            yield path, files
+            stack.extend([dir, None] for dir in reversed(dirs))
+
+# Like pool.imap, but at most 'window' tasks of 'chunksize' items are submitted ahead of the results consumed. The
+# input is read as the results are consumed instead of being drained by the task thread of the pool up front, so a
+# pipeline fed by it starts straight away and only holds a bounded number of items in memory.
+def imapwindow(pool, func, iterable, window, chunksize=1):
+    pending = collections.deque()
+    iterator = iter(iterable)
+    for chunk in iter(lambda: list(itertools.islice(iterator, chunksize)), []):
+        pending.append(pool.map_async(func, chunk, chunksize=chunksize))
+        if len(pending) >= window:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+# Labels of every file in a directory. Computed once per directory; equal labels share one interned tuple.
+def getdirlabels(dirpath, source, labelcache, root=False, verbose=False):
+    labelpath = dirpath
+    if not root:
+        labelpath = removeaffix(dirpath, prefix=source)
+    labels = tuple(sys.intern(label) for label in getlabels(trimpathsep(labelpath), verbose=verbose))
+    return labelcache.setdefault(labels, labels)
+
+# Per file messages are replaced by the periodic progress line of stats when progress is set
+def walkfiles(sources, unlabeled, root=False, abspath=False, verbose=False, quiet=False, stats=None, progress=False, threads=SCAN_THREADS):
+    j = 0
+    timings = {} if stats else None
+    labelcache = {}
+    for source in sources:
+        for dirpath, files in timeiter(scantree(source, threads=threads), timings, "walk"):
+            if stats:
+                stats.add(timings)
+                timings.clear()
+            labels = getdirlabels(dirpath, source, labelcache, root=root, verbose=verbose and len(files) > 0)
+            filedir = dirpath
+            if abspath:
+                filedir = os.path.abspath(dirpath)
+            for file in files:
+                filepath = os.path.join(filedir, file)
+                if not quiet and not progress:
+                    print("Currently processing image: " + file)
+                elif verbose:
+                    print("Currently processing image: " + filepath)
+                # If data is labeled
+                if labels[0]:
+                    yield j, filepath, labels
+                    j += 1
+                # Else, data is not labeled
+                else:
+                    if verbose:
+                        print("Current image is unlabeled. Image will be ignored.")
+                    unlabeled.write(filepath + "\n")
+                    if stats:
+                        stats.count("unlabeled")
+
+# Buffers text records (lines) and writes them to the file in batches of complete lines. Every flush leaves the file
+# in a valid state, so the output up to the last flushed batch survives if the run dies.
+class RecordWriter:
+    def __init__(self, filepath, batchsize=METADATA_BATCHSIZE, mode='x', beforeflush=None):
+        self.file = open(filepath, mode)
+        self.batchsize = batchsize
+        self.beforeflush = beforeflush
+        self.batch = []
+
+    def write(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            if self.beforeflush:
+                self.beforeflush()
+            self.file.write("".join(self.batch))
+            self.file.flush()
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def openrecords(name, path, batchsize=METADATA_BATCHSIZE, overwrite=False):
+    if overwrite:
+        return RecordWriter(os.path.join(path, name), batchsize=batchsize, mode='w')
+    filepath = iteratefilename(os.path.join(path, name), prefix="_")
+    try:
+        return RecordWriter(filepath, batchsize=batchsize)
+    except:
+        print("SOMETHING IS WRONG THIS SHOULD NEVER BE REACHED.")
+        sys.exit()
+
+def createdir(directory, label='', clean=False, verbose=False, quiet=False):
+    if not os.path.isdir(directory):
+        if not quiet:
+            print("The " + label + " directory '" + directory + "' does not exist. Creating directory...")
+        try:
+            os.makedirs(directory)
+            if verbose:
+                print("Created " + label + " directory: " + "'" + directory + "'")
+        except OSError as error:
+            if not quiet:
+                print("Failed to create " + label + " directory: '" + directory + "'")
+            return True
+    else:
+        if not quiet:
+            print("The " + label + " directory '" + directory + "' already exists.")
+        if clean:
+            return True
+    return False
+
+def iteratefilename(path, initial=0, prefix="_", suffix="", prepend=False):
+    newpath = path
+    while os.path.isfile(newpath):
+        if prepend:
+            newpath = modfilename(path, prefix=prefix+str(initial)+suffix)
+        else:
+            newpath = modfilename(path, suffix=prefix+str(initial)+suffix)
+        initial += 1
+    return newpath
+
+def exportfilelist(fileList, name, path):
+    file = openrecords(name, path)
+    for ele in fileList:
+        file.write(ele + "\n")
+    file.close()
@@ -1,12 +1,15 @@
 #import sklearn
 import numpy as np
 import os
-import sys
+import io
 import argparse
+import functools
+import time
+import concurrent.futures
 #from skimage import io, color, img_as_float
 #import matplotlib.pyplot as plt
 
-import clean_image as im
+import common_image as common
 
 
 def reformimage(shape, image):
@@ -37,42 +40,128 @@ def readmeta(filepath):
 
     return data
 
+# Shards are memory mapped once and shared by every image they hold
+@functools.lru_cache(maxsize=None)
+def openshard(path):
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+# Images are returned with the type they are stored as, quantized float images as float32 values
 def getimage(meta):
     labels = meta[0]
     shape = meta[1]
     format = meta[2]
     path = meta[3]
 
-    flatImage = np.loadtxt(path, dtype=format)
+    dtype, scale, shift = common.parseformat(format)
+    shardpath, offset = common.splitlocator(path)
+    if offset is not None:
+        # Zero copy view of the image inside the memory mapped shard
+        flatImage = np.frombuffer(openshard(shardpath), dtype=dtype, count=int(np.prod(shape)), offset=offset)
+    elif path.endswith(common.NPY_IMAGE_EXT):
+        flatImage = np.load(path, mmap_mode="r")
+    else:
+        # Compressed files are decompressed as a stream while parsing
+        with common.openinput(path) as file:
+            if common.NPY_IMAGE_EXT + os.extsep in os.path.basename(path):
+                # Parsed from memory: read_array asks the file for a descriptor, which decompressing streams lack
+                flatImage = np.load(io.BytesIO(file.read()))
+            else:
+                flatImage = np.loadtxt(file, dtype=dtype)
+    if scale is not None:
+        # Restore quantized float values
+        flatImage = flatImage.astype(np.float32) * np.float32(scale) + np.float32(shift)
     image = reformimage(shape, flatImage)
 
     return image
 
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument("meta", type=str, help="")
+# Images listed in a metadata file. The metadata is read once and every distinct set of labels is given a class index.
+# With numshards > 1 only every numshards-th image starting at shard is kept, so that several consumer processes
+# can each read a disjoint part of the dataset. Classes are taken from the whole dataset, so every shard maps the same
+# labels to the same target.
+class Dataset:
+    def __init__(self, metapath, shard=0, numshards=1):
+        meta = readmeta(metapath)
+        self.classes = sorted(set(tuple(entry[0]) for entry in meta))
+        self.classindex = {labels: i for i, labels in enumerate(self.classes)}
+        self.meta = meta[shard::numshards]
+        self.targets = np.array([self.classindex[tuple(meta[0])] for meta in self.meta], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.meta)
+
+    def __getitem__(self, index):
+        return getimage(self.meta[index]), self.targets[index]
+
+    # Positions of all images with the given labels
+    def indices(self, labels):
+        return np.flatnonzero(self.targets == self.classindex[tuple(labels)])
+
+    # Stack the images at the given positions. All of them must have the same shape.
+    def loadbatch(self, indices):
+        images = np.stack([getimage(self.meta[index]) for index in indices])
+        return images, self.targets[indices]
+
+    # Yield (images, targets) mini-batches. Up to 'prefetch' batches are decoded ahead of the consumer by a pool of
+    # background threads. With shuffle the order is randomised, reproducibly when a seed is given.
+    def batches(self, batchsize, shuffle=False, seed=None, droplast=False, prefetch=2, threads=4):
+        order = np.arange(len(self.meta))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+        stop = len(order)
+        if droplast:
+            stop -= stop % batchsize
+        starts = iter(range(0, stop, batchsize))
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            pending = []
+            for start in starts:
+                pending.append(executor.submit(self.loadbatch, order[start:start + batchsize]))
+                if len(pending) > prefetch:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
 
 
 #def showimage(image):
 #    i, (img) = plt.subplots(1)
 #    img.imshow(image)
 
-    #data = readmeta(TEST_META_FILE)
-
-    #for meta in data:
-    #    image = getimage(meta)
-
-    #    showimage(image)
-
-    #plt.show()
-
+def main():
+    parser = argparse.ArgumentParser(description="Read a dataset exported by clean_image.py in mini-batches and report the number of images, the labels, and the read throughput.")
+    parser.add_argument("meta", type=str, help="Path to the metadata file of the dataset.")
+    parser.add_argument("-b", "--batchsize", type=int, default=32, help="Number of images in each mini-batch.")
+    parser.add_argument("-s", "--shuffle", action="store_true", help="Shuffle the images before batching.")
+    parser.add_argument("--seed", type=int, help="Seed used to shuffle the images.")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Number of background threads decoding batches.")
+    parser.add_argument("-p", "--prefetch", type=int, default=2, help="Number of batches decoded ahead of the consumer.")
+    parser.add_argument("--shard", type=int, default=0, help="Index of the shard of the dataset to read.")
+    parser.add_argument("--numshards", type=int, default=1, help="Number of shards the dataset is split into.")
+    log_group = parser.add_mutually_exclusive_group()
+    log_group.add_argument("-v", "--verbose", action="store_true", help="Output actions to the console and show detailed information.")
+    log_group.add_argument("-q", "--quiet", action="store_true", help="Suppress ouptut to the console.")
+
+    args = parser.parse_args()
+
+    dataset = Dataset(args.meta, shard=args.shard, numshards=args.numshards)
+    if not args.quiet:
+        print("Number of images: " + str(len(dataset)))
+        print("Number of labels: " + str(len(dataset.classes)))
+    if args.verbose:
+        counts = np.bincount(dataset.targets, minlength=len(dataset.classes))
+        for labels, count in zip(dataset.classes, counts):
+            print(" ".join(labels) + ": " + str(count))
+
+    start = time.perf_counter()
+    count = 0
+    for images, targets in dataset.batches(args.batchsize, shuffle=args.shuffle, seed=args.seed, prefetch=args.prefetch, threads=args.threads):
+        count += len(targets)
+        if args.verbose:
+            print("Read batch of shape " + str(images.shape))
+    elapsed = time.perf_counter() - start
+    if not args.quiet:
+        print("Read " + str(count) + " images in " + str(round(elapsed, 3)) + " seconds.")
 
 
-
-
-
-
-
-#
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import os
+import sys
+import argparse
+import struct
+import json
+import csv
+import time
+import concurrent.futures
+
+import common_image as common
+
+
+# Number of leading bytes read to recognise the format of an image, enough to hold the dimensions of most formats
+HEADER_SIZE = 32
+INSPECT_THREADS = 16
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Channels of the decoded image for each PNG colour type (palette images are decoded to RGB, or RGBA with a tRNS chunk)
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+# Start of frame markers of every JPEG coding process (0xC4, 0xC8 and 0xCC are other segments)
+JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Bits per channel of PIL image modes which are not 8 bit
+MODE_BITS = {"1": 1, "I;16": 16, "I;16B": 16, "I;16L": 16, "I": 32, "F": 32}
+# Columns of the per image details file
+DETAIL_COLUMNS = ["path", "labels", "format", "width", "height", "channels", "bits", "bytes"]
+
+
+# Each reader gets the open file and its first HEADER_SIZE bytes and returns (width, height, channels, bits per channel)
+# of the decoded image, or None if the header is broken. Only headers are read, pixels are never decoded.
+def readpng(file, header):
+    width, height, bits, colour = struct.unpack(">IIBB", header[16:26])
+    channels = PNG_CHANNELS.get(colour)
+    if colour == 3:
+        bits = 8
+        # Chunks up to the image data are skipped through for a palette transparency chunk
+        file.seek(33)
+        while True:
+            chunk = file.read(8)
+            if len(chunk) < 8:
+                break
+            length, kind = struct.unpack(">I4s", chunk)
+            if kind == b"tRNS":
+                channels = 4
+                break
+            if kind in (b"IDAT", b"IEND"):
+                break
+            file.seek(length + 4, os.SEEK_CUR)
+    return width, height, channels, bits
+
+def readjpeg(file, header):
+    file.seek(2)
+    while True:
+        byte = file.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = file.read(1)
+        # Markers may be preceded by any number of fill bytes
+        while marker == b"\xff":
+            marker = file.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        # Image data or the end of the image before a frame header
+        if marker in (0xD9, 0xDA):
+            return None
+        # Markers without a segment
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        length = struct.unpack(">H", file.read(2))[0]
+        if marker in JPEG_SOF:
+            bits, height, width, channels = struct.unpack(">BHHB", file.read(6))
+            return width, height, channels, bits
+        file.seek(length - 2, os.SEEK_CUR)
+
+def readgif(file, header):
+    width, height = struct.unpack("<HH", header[6:10])
+    return width, height, 3, 8
+
+def readbmp(file, header):
+    size = struct.unpack("<I", header[14:18])[0]
+    if size == 12:
+        width, height, planes, count = struct.unpack("<HHHH", header[18:26])
+    else:
+        width, height, planes, count = struct.unpack("<iiHH", header[18:30])
+    channels = 3
+    if count == 32 and size >= 56:
+        # The fourth byte of a pixel is only alpha with bit field compression and an alpha mask
+        file.seek(30)
+        compression = struct.unpack("<I", file.read(4))[0]
+        file.seek(66)
+        if compression in (3, 6) and struct.unpack("<I", file.read(4))[0]:
+            channels = 4
+    # Rows are stored top down when the height is negative
+    return width, abs(height), channels, 5 if count == 16 else 8
+
+def readwebp(file, header):
+    kind = header[12:16]
+    if kind == b"VP8 ":
+        width, height = struct.unpack("<HH", header[26:30])
+        return width & 0x3FFF, height & 0x3FFF, 3, 8
+    if kind == b"VP8L":
+        fields = int.from_bytes(header[21:25], "little")
+        return (fields & 0x3FFF) + 1, ((fields >> 14) & 0x3FFF) + 1, 4 if (fields >> 28) & 1 else 3, 8
+    if kind == b"VP8X":
+        width = int.from_bytes(header[24:27], "little") + 1
+        height = int.from_bytes(header[27:30], "little") + 1
+        return width, height, 4 if header[20] & 0x10 else 3, 8
+    return None
+
+def readtiff(file, header):
+    order = "<" if header[:2] == b"II" else ">"
+    file.seek(struct.unpack(order + "I", header[4:8])[0])
+    count = struct.unpack(order + "H", file.read(2))[0]
+    entries = file.read(count * 12)
+    # ImageWidth, ImageLength, BitsPerSample and SamplesPerPixel of the first image
+    tags = {258: 1, 277: 1}
+    for k in range(count):
+        tag, kind, number, value = struct.unpack(order + "HHI4s", entries[k * 12:k * 12 + 12])
+        if tag not in (256, 257, 258, 277):
+            continue
+        if kind == 3:
+            if number > 2:
+                # Values which do not fit the entry are stored at an offset, the first one is enough
+                file.seek(struct.unpack(order + "I", value)[0])
+                value = file.read(2)
+            tags[tag] = struct.unpack(order + "H", value[:2])[0]
+        elif kind == 4:
+            tags[tag] = struct.unpack(order + "I", value)[0]
+    if 256 not in tags or 257 not in tags:
+        return None
+    return tags[256], tags[257], tags[277], tags[258]
+
+def detectformat(header):
+    if header.startswith(PNG_SIGNATURE):
+        return "png", readpng
+    if header.startswith(b"\xff\xd8"):
+        return "jpeg", readjpeg
+    if header.startswith(b"GIF8"):
+        return "gif", readgif
+    if header.startswith(b"BM"):
+        return "bmp", readbmp
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "webp", readwebp
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff", readtiff
+    return None, None
+
+# Format, width, height, channels, bits per channel and size in bytes of an image file. Formats without a reader of
+# their own are opened with PIL if it is installed, which also only reads the header. Unknown or broken images have
+# the format "unknown" and no dimensions.
+def inspectimage(filepath):
+    try:
+        with open(filepath, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            header = file.read(HEADER_SIZE)
+            format, reader = detectformat(header)
+            if reader is not None:
+                shape = reader(file, header)
+                if shape is not None:
+                    return [format] + list(shape) + [size]
+    except (OSError, struct.error, IndexError):
+        size = None
+    Image = common.importpil()
+    if Image is not None:
+        try:
+            with Image.open(filepath) as image:
+                return [image.format.lower(), image.size[0], image.size[1], len(image.getbands()), MODE_BITS.get(image.mode, 8), size]
+        except Exception:
+            pass
+    return ["unknown", None, None, None, None, size]
+
+# Inspect the images of the (index, path, labels) jobs on a pool of threads, as the time goes to reading files. Yields
+# (job, inspection) in the order of the jobs.
+def inspectfiles(jobs, threads=INSPECT_THREADS):
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending = []
+        for job in jobs:
+            pending.append((job, executor.submit(inspectimage, job[1])))
+            if len(pending) >= threads * 4:
+                job, future = pending.pop(0)
+                yield job, future.result()
+        for job, future in pending:
+            yield job, future.result()
+
+# Histograms of the images of a label: formats, channels, bits per channel and the longer side in power of two buckets
+# along with the range of widths and heights and the total size.
+class Profile:
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.formats = {}
+        self.channels = {}
+        self.bits = {}
+        self.sizes = {}
+        self.width = [None, None]
+        self.height = [None, None]
+
+    def add(self, format, width, height, channels, bits, size):
+        self.count += 1
+        self.bytes += size or 0
+        self.formats[format] = self.formats.get(format, 0) + 1
+        if width is None:
+            return
+        self.channels[channels] = self.channels.get(channels, 0) + 1
+        self.bits[bits] = self.bits.get(bits, 0) + 1
+        bucket = 2 ** max(max(width, height) - 1, 0).bit_length()
+        self.sizes[bucket] = self.sizes.get(bucket, 0) + 1
+        self.width = [width if self.width[0] is None else min(self.width[0], width), max(self.width[1] or 0, width)]
+        self.height = [height if self.height[0] is None else min(self.height[0], height), max(self.height[1] or 0, height)]
+
+    def report(self):
+        return {"images": self.count, "bytes": self.bytes, "formats": self.formats, "channels": {str(key): value for key, value in sorted(self.channels.items())}, "bits": {str(key): value for key, value in sorted(self.bits.items())}, "longer_side": {"<=" + str(key): value for key, value in sorted(self.sizes.items())}, "width": self.width, "height": self.height}
+
+def formathistogram(histogram):
+    return ", ".join([str(key) + ": " + str(value) for key, value in histogram.items()])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile an image dataset without decoding any image. Take image files from source directories, labeled by the directory tree in the same way as clean_image.py, and read only the file headers (JPEG, PNG, GIF, BMP, WebP and TIFF, other formats through PIL if installed) to report the number of labels and images and, for every label, histograms of the image formats, number of colour channels, bits per channel and resolution.")
+    parser.add_argument("-s", "--source", action="append", type=str, help="Path to the source directory holding image files to be profiled. The folder names of the directory tree determines the labels for each image. Each extra argument will add another source directory to the list of directories.")
+    parser.add_argument("-r", "--root", action="store_true", help="Do not ignore the root directory name in the labeling process for each source file.")
+    parser.add_argument("-o", "--output", type=str, help="Path to a JSON file in which the profile of the whole dataset and of every label is stored.")
+    parser.add_argument("-d", "--details", type=str, help="Path to a CSV file in which the path, labels, format, width, height, number of channels, bits per channel and size in bytes of every image is stored.")
+    parser.add_argument("-t", "--threads", type=int, default=INSPECT_THREADS, help="Number of threads reading image headers.")
+    parser.add_argument("--scanthreads", type=int, default=common.SCAN_THREADS, help="Number of threads listing source directories ahead of profiling.")
+    log_group = parser.add_mutually_exclusive_group()
+    log_group.add_argument("-v", "--verbose", action="store_true", help="Output actions to the console and show the profile of every label.")
+    log_group.add_argument("-q", "--quiet", action="store_true", help="Suppress ouptut to the console.")
+
+    args = parser.parse_args()
+
+    if not args.source or common.checkdirs(args.source, label="source", verbose=args.verbose, quiet=args.quiet):
+        sys.exit()
+    if args.threads < 1:
+        if not args.quiet:
+            print("Number of threads must be at least 1.")
+        sys.exit()
+
+    start = time.perf_counter()
+    stats = common.Stats(quiet=True)
+    total = Profile()
+    profiles = {}
+    details = None
+    detailsfile = None
+    if args.details:
+        detailsfile = open(args.details, "w", newline="")
+        details = csv.writer(detailsfile, lineterminator="\n")
+        details.writerow(DETAIL_COLUMNS)
+    try:
+        with open(os.devnull, "w") as unlabeled:
+            jobs = common.walkfiles(args.source, unlabeled, root=args.root, quiet=True, stats=stats, progress=True, threads=args.scanthreads)
+            for (j, filepath, labels), inspection in inspectfiles(jobs, threads=args.threads):
+                label = " ".join(labels)
+                if label not in profiles:
+                    profiles[label] = Profile()
+                profiles[label].add(*inspection)
+                total.add(*inspection)
+                if details:
+                    details.writerow([filepath, label] + inspection)
+    finally:
+        if detailsfile:
+            detailsfile.close()
+    elapsed = time.perf_counter() - start
+    unlabeled = stats.counts.get("unlabeled", 0)
+
+    if args.output:
+        report = {"elapsed_seconds": elapsed, "labels": len(profiles), "unlabeled": unlabeled, "total": total.report(), "per_label": {label: profiles[label].report() for label in sorted(profiles)}}
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if not args.quiet:
+        print("Number of images: " + str(total.count))
+        print("Number of labels: " + str(len(profiles)))
+        print("Number of unlabeled images: " + str(unlabeled))
+        print("Unknown or broken images: " + str(total.formats.get("unknown", 0)))
+        print("Profiled in " + str(round(elapsed, 3)) + " seconds.")
+    if args.verbose:
+        for label in sorted(profiles):
+            report = profiles[label].report()
+            print(label + ": " + str(report["images"]) + " images")
+            print("    formats: " + formathistogram(report["formats"]))
+            print("    channels: " + formathistogram(report["channels"]))
+            print("    bits: " + formathistogram(report["bits"]))
+            print("    longer side: " + formathistogram(report["longer_side"]))
+            print("    width: " + str(report["width"][0]) + "-" + str(report["width"][1]) + ", height: " + str(report["height"][0]) + "-" + str(report["height"][1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,96 @@
-import numpy as np
 import os
 import sys
 import argparse
+import functools
+import multiprocessing
+import multiprocessing.connection
+import signal
+import shutil
 import string
-#from pdfminer.pdfparser import PDFParser
+import io
+import json
+import hashlib
+import time
+import cProfile
+import tracemalloc
+import threading
+import concurrent.futures
+import sqlite3
+import csv
+import zlib
+import codecs
+import html.parser
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from common_text import META_COLUMNS, LABEL_SEP, TEXT_BOMS, TEXT_ENCODINGS, SHARD_ENCODING, SHARD_OFFSET_SEP, SHARD_LENGTH_SEP, COMPRESSION_CODECS, METADATA_BATCHSIZE, SCAN_THREADS, VOCAB_FILENAME, TOKENS_FILENAME, TOKENS_INDEX_FILENAME
+from common_text import importpyarrow, checkdirs, modfilename, splitlocator, checkcodec, codecext, opencompressed, openinput, RecordWriter, openrecords, tokendtype, createdir, iteratefilename, readflat, readdocument, timestage, Stats, walkfiles, imapwindow
+# NumPy, pyarrow and pdfminer are imported by the functions that use them, which keeps startup fast
 
 
 METADATA_FILENAME = "metadata.csv"
+METADATA_FORMATS = ["text", "npy", "parquet"]
+COLUMNS_FILENAMES = {"npy": "metadata.npy", "parquet": "metadata.parquet"}
 UNLABELED_FILENAME = "unlabeled.csv"
 USELESS_FILENAME = "useless.csv"
+DUPLICATES_FILENAME = "duplicates.csv"
+FAILED_FILENAME = "failed.csv"
 FLAT_TEXT_EXT = ".csv"
+SHARD_FILENAME = "shard_"
+SHARD_EXT = ".txt"
+STORAGE_TYPES = ["text", "shard"]
+WRITER_PENDING = 64
+MANIFEST_FILENAME = "manifest.jsonl"
+HASH_CHUNKSIZE = 1024 * 1024
+TEMP_FILE_PREFIX = "tmp_"
+# Number of documents handed to a worker at a time
+WORKER_CHUNKSIZE = 64
+# Chunks of documents fingerprinted ahead of the deduplication, per worker
+FINGERPRINT_WINDOW = 4
+# Default limits of every file extracted by an isolated extractor: seconds and megabytes of address space
+EXTRACT_TIMEOUT = 60
+EXTRACT_MEMORY = 4096
+EXTRACT_CACHE_DIRNAME = "extracted"
+EXTRACT_CACHE_EXT = ".json"
+EXTRACT_FAILED_EXT = ".failed"
+# Contents of these HTML elements are not displayed. Block elements (and line breaks) start a new line.
+HTML_HIDDEN_TAGS = ["script", "style", "template", "noscript"]
+HTML_BLOCK_TAGS = ["address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol", "p", "pre", "section", "table", "td", "th", "title", "tr", "ul"]
+DEDUP_METHODS = ["exact", "minhash"]
+# Near duplicate documents are compared by the MinHash signatures of their shingles (runs of SHINGLE_SIZE words)
+SHINGLE_SIZE = 3
+MINHASH_PERMUTATIONS = 128
+MINHASH_SEED = 1
+# Number of shingles hashed at a time, which bounds the memory used for long documents
+MINHASH_BLOCKSIZE = 4096
+SIMILARITY = 0.8
+# Id 0 of every vocabulary, standing in for the words pruned from it
+UNKNOWN_TOKEN = "<unk>"
+# Number of token ids converted to their final id at a time
+TOKENS_BLOCKSIZE = 1024 * 1024
+# Number of bytes read at a time from streamed documents
+STREAM_BLOCKSIZE = 4 * 1024 * 1024
+# Whitespace characters streamed documents may be cut at; documents are never cut at other whitespace.
+STREAM_CUTS = " \n\t"
+# Joins documents formatted as a batch. Not whitespace, punctuation, a digit or a cased letter.
+BATCH_SEPARATOR = "\x00"
 
 
-def removeaffix(string, prefix=None, suffix=None):
-    if prefix:
-        try:
-            string = string.removeprefix(prefix)
-        except:
-            if string.startswith(prefix):
-                string = string[len(prefix):]
-    if suffix:
-        try:
-            string = string.removesuffix(suffix)
-        except:
-            if string.endswith(suffix):
-                string = string[:-len(suffix)]
-    return string
-
-def trimpathsep(path, leading=True, trailing=True):
-    if leading and trailing:
-        return path.strip(os.sep)
-    elif leading:
-        return path.lstrip(os.sep)
-    elif trailing:
-        return path.rstrip(os.sep)
-
-def checkdirs(dirs, dirlabel="", verbose=False, quiet=False):
-    invalid = False
-    for dir in dirs:
-        invalid = checkdir(dir, dirlabel=dirlabel, verbose=verbose, quiet=quiet)
-        if invalid and not verbose:
-            return invalid
-    return invalid
-
-def checkdir(directory, dirlabel="", verbose=False, quiet=False):
-    if not os.path.isdir(directory):
-        if verbose:
-            print("The " + dirlabel + " directory: '" + dir + "'" + " does not exist.")
-        elif not quiet:
-            print("Some " + dirlabel + " path(s) are invalid.")
-        return True
-    return False
-
-def modfilename(path, prefix="", suffix=""):
-    root, file = os.path.split(path)
-    file, ext = os.path.splitext(file)
-    file = prefix + file + suffix
-    return os.path.join(root, file + ext)
-
-def getlabels(path, delimiter=os.sep, verbose=False):
-    labels = path.split(delimiter)
-    if verbose:
-        if labels[0]:
-            print("The labels for text are: " + str(labels))
-    return labels
-
-def getmeta(text, verbose=False):
+# Character and word count of the formatted text. Given the (line count, byte length, encoding) of the source
+# document the number of unique words and the source statistics are added for the columnar metadata.
+def getmeta(text, source=None, verbose=False):
     charcount = len(text)
-    wordcount = len(text.split())
-    meta = [charcount, wordcount]
+    words = text.split()
+    meta = [charcount, len(words)]
+    if source is not None:
+        linecount, bytecount, encoding = source
+        meta += [linecount, len(set(words)), bytecount, encoding]
     return meta
 
 def checkuseful(meta, minchars=0, maxchars=0, verbose=False):
-    charcount, wordcount = meta
+    charcount = meta[0]
     if charcount == 0:
         return False
     elif minchars == 0 and maxchars == 0:
@@ -84,113 +102,1271 @@ def checkuseful(meta, minchars=0, maxchars=0, verbose=False):
     else:
         return False
 
-def savetext(text, filename, directory, compress=False, abspath=False):
+def outputpath(filename, directory, compress=False, abspath=False, codec="gzip"):
     ext = FLAT_TEXT_EXT
     if compress:
-        ext += ".gz"
+        ext += codecext(codec)
     filepath = os.path.join(directory, filename + ext)
     if abspath:
         filepath = os.path.abspath(filepath)
+    return filepath
+
+def savetext(text, filename, directory, compress=False, abspath=False, codec="gzip", level=None):
+    filepath = outputpath(filename, directory, compress=compress, abspath=abspath, codec=codec)
+    writetext(text, filepath, compress=compress, codec=codec, level=level)
+    return filepath
 
-    with open(filepath, "w") as file:
+def writetext(text, filepath, compress=False, codec="gzip", level=None):
+    with opentext(filepath, compress=compress, codec=codec, level=level) as file:
         file.write(text)
 
-    return filepath
+def opentext(filepath, compress=False, codec="gzip", level=None):
+    if compress:
+        return io.TextIOWrapper(opencompressed(filepath, codec=codec, level=level))
+    return open(filepath, "w")
+
+def checkoutput(path):
+    shardpath, offset, length = splitlocator(path)
+    if offset is not None:
+        return os.path.isfile(shardpath) and os.path.getsize(shardpath) >= offset + length
+    return os.path.isfile(path)
+
+# Remove an output file. Documents inside a shard are left in place.
+def removeoutput(path):
+    shardpath, offset, length = splitlocator(path)
+    if offset is None and os.path.isfile(path):
+        os.remove(path)
+
+# Read a saved document back from its output file or shard locator
+def readoutput(path):
+    shardpath, offset, length = splitlocator(path)
+    if offset is None:
+        return readflat(path)
+    with open(shardpath, "rb") as file:
+        file.seek(offset)
+        return file.read(length).decode(SHARD_ENCODING)
+
+# Appends documents to large shard files instead of writing one file per document. Each document is referenced by a
+# locator holding the shard path, byte offset and byte length so it can be read back directly from a memory map.
+class ShardWriter:
+    def __init__(self, directory, shardsize, abspath=False, fsync=False):
+        self.directory = directory
+        self.shardsize = shardsize
+        self.abspath = abspath
+        self.fsync = fsync
+        self.index = 0
+        self.file = None
+        self.path = None
+        self.offset = 0
+
+    def shardpath(self, index):
+        path = os.path.join(self.directory, SHARD_FILENAME + str(index).zfill(5) + SHARD_EXT)
+        if self.abspath:
+            path = os.path.abspath(path)
+        return path
+
+    def open(self):
+        # Never append to or replace shards of an earlier run, their documents may still be referenced
+        self.path = self.shardpath(self.index)
+        while os.path.exists(self.path):
+            self.index += 1
+            self.path = self.shardpath(self.index)
+        self.file = open(self.path, "xb")
+        self.offset = 0
+
+    def write(self, text):
+        data = text.encode(SHARD_ENCODING)
+        if self.file is None or (self.offset > 0 and self.offset + len(data) > self.shardsize):
+            self.close()
+            self.open()
+        locator = self.path + SHARD_OFFSET_SEP + str(self.offset) + SHARD_LENGTH_SEP + str(len(data))
+        self.file.write(data)
+        self.offset += len(data)
+        return locator
+
+    # Append the text saved in a file, block by block, and remove the file
+    def copy(self, filepath):
+        if self.file is None or (self.offset > 0 and self.offset + os.path.getsize(filepath) > self.shardsize):
+            self.close()
+            self.open()
+        offset = self.offset
+        with open(filepath, "r") as file:
+            for text in iter(functools.partial(file.read, STREAM_BLOCKSIZE), ""):
+                data = text.encode(SHARD_ENCODING)
+                self.file.write(data)
+                self.offset += len(data)
+        os.remove(filepath)
+        return self.path + SHARD_OFFSET_SEP + str(offset) + SHARD_LENGTH_SEP + str(self.offset - offset)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+# Runs file writes (and their compression) on a pool of threads. At most 'pending' writes are queued at once so the
+# processing loop is held back instead of buffering an unbounded amount of output in memory. With 'fsync' set, written
+# files are synced to stable storage in batches of that many files rather than one at a time.
+class BackgroundWriter:
+    def __init__(self, threads, pending=WRITER_PENDING, fsync=0):
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.pending = pending
+        self.slots = threading.BoundedSemaphore(pending)
+        self.errors = []
+        self.fsync = fsync
+        self.unsynced = []
+        self.lock = threading.Lock()
+
+    # Write the file at filepath by calling func(*args, **kwargs) on a writer thread
+    def submit(self, filepath, func, *args, **kwargs):
+        # Stop at the first failed write instead of processing everything else for nothing
+        if self.errors:
+            raise self.errors[0]
+        self.slots.acquire()
+        future = self.executor.submit(self.run, filepath, func, args, kwargs)
+        future.add_done_callback(self.done)
+        return future
+
+    def run(self, filepath, func, args, kwargs):
+        func(*args, **kwargs)
+        if self.fsync:
+            with self.lock:
+                self.unsynced.append(filepath)
+                if len(self.unsynced) < self.fsync:
+                    return
+                batch = self.unsynced
+                self.unsynced = []
+            syncfiles(batch)
+
+    # The slot is only given back once a failure is recorded, so drain never misses the error of the last writes
+    def done(self, future):
+        try:
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+        finally:
+            self.slots.release()
+
+    # Sync every file written so far which has not been synced yet
+    def sync(self):
+        with self.lock:
+            batch = self.unsynced
+            self.unsynced = []
+        syncfiles(batch)
+
+    # Wait until every write submitted so far has finished (and is synced when syncing)
+    def drain(self):
+        for slot in range(self.pending):
+            self.slots.acquire()
+        for slot in range(self.pending):
+            self.slots.release()
+        if self.errors:
+            raise self.errors[0]
+        self.sync()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+        self.sync()
+
+# Flush files to stable storage followed by the directories holding them, so that their names are durable as well.
+# Directories cannot be synced on every platform.
+def syncfiles(filepaths):
+    directories = set()
+    for filepath in filepaths:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(filepath) or os.curdir)
+    for directory in directories:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def formatmeta(labels, textmeta, textpath):
+    # labels: num labels followed by each label
+    line = str(len(labels)) + " "
+    for label in labels:
+        label = "_".join(label.split())
+        line += str(label) + " "
+    # text metadata [charcount, wordcount]
+    for count in textmeta:
+        line += str(count) + " "
+    # path to the flattened text file (.csv) or shard locator
+    return line + textpath + "\n"
+
+# Collects the metadata of every document as typed columns (META_COLUMNS) of a structured NumPy array (.npy) or a
+# Parquet table, so the whole metadata is loaded in one read and filtered column at a time instead of parsing it line
+# by line. Labels are kept as they are, joined by LABEL_SEP. Rows are written 'batchsize' documents at a time so the
+# metadata of a large dataset is never held in memory: Parquet batches become the row groups of the table, while npy
+# batches are saved one after another to a temporary file and combined into one array at close, as its string columns
+# need the length of their longest value up front.
+class ColumnWriter:
+    def __init__(self, filepath, format="npy", batchsize=METADATA_BATCHSIZE):
+        self.filepath = filepath
+        self.format = format
+        self.batchsize = batchsize
+        self.rows = []
+        self.count = 0
+        self.batches = 0
+        # Length of the longest value of each string column so far
+        self.widths = {name: 1 for name, kind in META_COLUMNS if kind == "U"}
+        # Written under a temporary name so an existing metadata file is only replaced by a complete one
+        self.temppath = modfilename(filepath, prefix=TEMP_FILE_PREFIX)
+        self.batchpath = modfilename(filepath, prefix=TEMP_FILE_PREFIX, suffix="_batches")
+        self.file = None
+        self.writer = None
+
+    def write(self, labels, meta, textpath):
+        self.rows.append((LABEL_SEP.join(labels), *meta, textpath))
+        if len(self.rows) >= self.batchsize:
+            self.flush()
+
+    def dtype(self):
+        return [(name, kind + str(self.widths[name]) if kind == "U" else kind) for name, kind in META_COLUMNS]
+
+    def table(self, columns):
+        import numpy as np
+        pyarrow, parquet = importpyarrow()
+        arrays = {}
+        for column, (name, kind) in zip(columns, META_COLUMNS):
+            if kind == "U":
+                arrays[name] = pyarrow.array(column, type=pyarrow.string())
+            else:
+                arrays[name] = pyarrow.array(column, type=pyarrow.from_numpy_dtype(np.dtype(kind)))
+        # Labels and encodings repeat for many documents
+        arrays["labels"] = arrays["labels"].dictionary_encode()
+        arrays["encoding"] = arrays["encoding"].dictionary_encode()
+        return pyarrow.table(arrays)
+
+    def flush(self):
+        import numpy as np
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        for column, (name, kind) in zip(columns, META_COLUMNS):
+            if kind == "U":
+                self.widths[name] = max(self.widths[name], max([len(value) for value in column]))
+        if self.format == "parquet":
+            table = self.table(columns)
+            if self.writer is None:
+                pyarrow, parquet = importpyarrow()
+                self.writer = parquet.ParquetWriter(self.temppath, table.schema)
+            self.writer.write_table(table)
+        else:
+            if self.file is None:
+                self.file = open(self.batchpath, "wb")
+            np.save(self.file, np.array(self.rows, dtype=self.dtype()))
+            self.batches += 1
+        self.count += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        import numpy as np
+        self.flush()
+        if self.format == "parquet":
+            if self.writer is None:
+                pyarrow, parquet = importpyarrow()
+                parquet.write_table(self.table([()] * len(META_COLUMNS)), self.temppath)
+            else:
+                self.writer.close()
+        else:
+            array = np.lib.format.open_memmap(self.temppath, mode="w+", dtype=self.dtype(), shape=(self.count,))
+            if self.file is not None:
+                self.file.close()
+                offset = 0
+                with open(self.batchpath, "rb") as file:
+                    for _ in range(self.batches):
+                        batch = np.load(file)
+                        for name in batch.dtype.names:
+                            array[name][offset:offset + len(batch)] = batch[name]
+                        offset += len(batch)
+                os.remove(self.batchpath)
+            array.flush()
+            del array
+        os.replace(self.temppath, self.filepath)
+
+def opencolumns(format, path, overwrite=False, batchsize=METADATA_BATCHSIZE):
+    filepath = os.path.join(path, COLUMNS_FILENAMES[format])
+    if not overwrite:
+        filepath = iteratefilename(filepath, prefix="_")
+    return ColumnWriter(filepath, format=format, batchsize=batchsize)
+
+# Add the metadata of a document to the metadata file, either text lines or columns
+def exportrecord(data, labels, meta, textpath):
+    if isinstance(data, ColumnWriter):
+        data.write(labels, meta, textpath)
+    else:
+        data.write(formatmeta(labels, meta, textpath))
 
 def exportmeta(data, path):
-    filepath = iteratefilename(os.path.join(path, METADATA_FILENAME), prefix="_")
-    try:
-        file = open(filepath, 'x')
-    except:
-        print("SOMETHING IS WRONG THIS SHOULD NEVER BE REACHED.")
-        sys.exit()
+    file = openrecords(METADATA_FILENAME, path)
     for text in data:
         labels, textmeta, textpath = text
-        # labels: num labels followed by each label
-        file.write(str(len(labels)) + " ")
-        for label in labels:
-            label = "_".join(label.split())
-            file.write(str(label) + " ")
-        # text metadata [charcount, wordcount]
-        for count in textmeta:
-            file.write(str(count) + " ")
-        # path to the flattened text file (.csv)
-        file.write(textpath + "\n")
+        file.write(formatmeta(labels, textmeta, textpath))
     file.close()
 
-def createdir(directory, dirlabel='', clean=False, verbose=False, quiet=False):
-    if not os.path.isdir(directory):
-        if not quiet:
-            print("The " + dirlabel + " directory '" + directory + "' does not exist. Creating directory...")
-        try:
-            os.makedirs(directory)
-            if verbose:
-                print("Created " + dirlabel + " directory: " + "'" + directory + "'")
-        except OSError as error:
-            if not quiet:
-                print("Failed to create " + dirlabel + " directory: '" + directory + "'")
-            return True
-    else:
-        if not quiet:
-            print("The " + dirlabel + " directory '" + directory + "' already exists.")
-        if clean:
-            return True
-    return False
-
-def iteratefilename(path, initial=0, prefix="_", suffix="", prepend=False):
-    newpath = path
-    while os.path.isfile(newpath):
-        if prepend:
-            newpath = modfilename(path, prefix=prefix+str(initial)+suffix)
+# Token ids of each formatted text (None for none) in the ids of a vocabulary of the texts alone, so a worker needs no
+# shared state. Texts already tokenized into 'ids' (see streamdocument) are given as their id array. Returns the words
+# of that vocabulary, the number of times each is used and the id array of each text.
+def tokenizetexts(texts, ids=None):
+    import numpy as np
+    if ids is None:
+        ids = {}
+    arrays = []
+    for text in texts:
+        if text is None or isinstance(text, np.ndarray):
+            arrays.append(text)
         else:
-            newpath = modfilename(path, suffix=prefix+str(initial)+suffix)
-        initial += 1
-    return newpath
+            arrays.append(np.array([ids.setdefault(word, len(ids)) for word in text.split()], dtype=np.uint32))
+    words = [array for array in arrays if array is not None]
+    counts = np.bincount(np.concatenate(words), minlength=len(ids)) if words else np.zeros(0, dtype=np.int64)
+    return list(ids), counts, arrays
 
-def exportfilelist(fileList, name, path):
-    filepath = iteratefilename(os.path.join(path, name), prefix="_")
-    try:
-        file = open(filepath, 'x')
-    except:
-        print("SOMETHING IS WRONG THIS SHOULD NEVER BE REACHED.")
-        sys.exit()
+# Builds the vocabulary of the exported documents and stores each document as an array of token ids. add() merges the
+# word counts of a tokenized chunk into the totals and returns the table from the chunk's own ids to provisional ids,
+# which write() appends to a temporary file one document at a time. At close the vocabulary is sorted by frequency and
+# pruned: words used fewer than 'mincount' times, or beyond the 'maxsize' most frequent, become UNKNOWN_TOKEN. The
+# vocabulary is stored one "<word> <count>" line per id and the provisional ids are converted block by block into the
+# token file as uint16 when the vocabulary fits and uint32 otherwise.
+class TokenWriter:
+    def __init__(self, directory, mincount=1, maxsize=0):
+        import numpy as np
+        self.directory = directory
+        self.mincount = mincount
+        self.maxsize = maxsize
+        self.ids = {}
+        self.counts = np.zeros(1024, dtype=np.int64)
+        self.offsets = [0]
+        # Provisional ids, in order of first use
+        self.temppath = modfilename(os.path.join(directory, TOKENS_FILENAME), prefix=TEMP_FILE_PREFIX, suffix="_ids")
+        self.file = open(self.temppath, "wb")
 
-    for ele in fileList:
-        file.write(ele + "\n")
+    def add(self, words, counts):
+        import numpy as np
+        lookup = np.array([self.ids.setdefault(word, len(self.ids)) for word in words], dtype=np.uint32)
+        if len(self.ids) > len(self.counts):
+            grown = np.zeros(max(len(self.ids), 2 * len(self.counts)), dtype=np.int64)
+            grown[:len(self.counts)] = self.counts
+            self.counts = grown
+        self.counts[lookup] += counts
+        return lookup
 
-    file.close()
+    def write(self, tokens):
+        tokens.tofile(self.file)
+        self.offsets.append(self.offsets[-1] + len(tokens))
+
+    def close(self):
+        import numpy as np
+        self.file.close()
+        words = list(self.ids)
+        counts = self.counts[:len(words)].tolist()
+        # Ties are broken by the word so the vocabulary does not depend on the order of the documents
+        keep = [k for k in sorted(range(len(words)), key=lambda k: (-counts[k], words[k])) if counts[k] >= self.mincount and words[k] != UNKNOWN_TOKEN]
+        if self.maxsize:
+            keep = keep[:self.maxsize - 1]
+        lookup = np.zeros(len(words), dtype=np.int64)
+        lookup[keep] = np.arange(1, len(keep) + 1)
+        lookup = lookup.astype(tokendtype(len(keep) + 1))
+        vocabpath = os.path.join(self.directory, VOCAB_FILENAME)
+        tokenspath = os.path.join(self.directory, TOKENS_FILENAME)
+        indexpath = os.path.join(self.directory, TOKENS_INDEX_FILENAME)
+        with open(modfilename(vocabpath, prefix=TEMP_FILE_PREFIX), "w") as file:
+            file.write(UNKNOWN_TOKEN + " " + str(sum(counts) - sum([counts[k] for k in keep])) + "\n")
+            file.writelines([words[k] + " " + str(counts[k]) + "\n" for k in keep])
+        with open(self.temppath, "rb") as source, open(modfilename(tokenspath, prefix=TEMP_FILE_PREFIX), "wb") as target:
+            while True:
+                block = np.fromfile(source, dtype=np.uint32, count=TOKENS_BLOCKSIZE)
+                if not len(block):
+                    break
+                lookup[block].tofile(target)
+        with open(modfilename(indexpath, prefix=TEMP_FILE_PREFIX), "wb") as file:
+            np.save(file, np.array(self.offsets, dtype=np.int64))
+        os.remove(self.temppath)
+        for path in (vocabpath, tokenspath, indexpath):
+            os.replace(modfilename(path, prefix=TEMP_FILE_PREFIX), path)
+
+def hashfile(filepath):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as file:
+        for chunk in iter(functools.partial(file.read, HASH_CHUNKSIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Load the manifest records of previous runs keyed by source path. Later records replace earlier ones for the same
+# source. Records written by a run with different output options cannot be reused and are discarded.
+def loadmanifest(filepath, options, verbose=False, quiet=False):
+    records = {}
+    if not os.path.isfile(filepath):
+        return records
+    with open(filepath, "r") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partially written record at the end of a crashed run
+                continue
+            if "options" in record:
+                if record["options"] != options:
+                    if not quiet:
+                        print("The manifest was created with different options. All files will be processed again.")
+                    return {}
+            else:
+                records[record["source"]] = record
+    if verbose:
+        print("Loaded " + str(len(records)) + " records from the manifest.")
+    return records
+
+# Rewrite the manifest with only the given records. The file is replaced atomically.
+def writemanifest(filepath, records, options):
+    temppath = filepath + ".tmp"
+    with open(temppath, "w") as file:
+        file.write(json.dumps({"options": options}) + "\n")
+        for record in records.values():
+            file.write(json.dumps(record) + "\n")
+    os.replace(temppath, filepath)
+
+# Check if the output of a previous run can be reused for the source file. Only the size and modification time are
+# compared unless the modification time changed, in which case the contents are hashed.
+def checkunchanged(record, filepath, size, mtime):
+    if record is None or record["size"] != size:
+        return False
+    if record["mtime"] != mtime:
+        if hashfile(filepath) != record["hash"]:
+            return False
+        record["mtime"] = mtime
+    if record["useful"] and not checkoutput(record["output"]):
+        return False
+    return True
+
+# Translation table deleting punctuation and/or every character that is a digit (as str.isdigit). Built once for
+# each combination of options.
+@functools.lru_cache(maxsize=None)
+def gettranslation(punctuation=False, alpha=False):
+    delete = ""
+    if not punctuation:
+        delete += string.punctuation
+    if alpha:
+        delete += "".join(chr(i) for i in range(sys.maxunicode + 1) if chr(i).isdigit())
+    return str.maketrans('', '', delete)
 
 # notrim = do not trim, punctuation = dont remove punctuation, alpha = remove numbers, case = keep original case
 def formattext(text, notrim=False, punctuation=False, alpha=False, case=False, quiet=False, verbose=False):
     if not notrim:
         # Remove all whitespace and replace with singular space
         text = " ".join(text.split())
-    if not punctuation:
-        # Remove all punctuation
-        text = text.translate(str.maketrans('', '', string.punctuation))
-    if alpha:
-        # Remove all numbers
-        text = "".join(i for i in text if not i.isdigit())
+    if not punctuation or alpha:
+        # Remove all punctuation and/or all numbers in a single pass
+        text = text.translate(gettranslation(punctuation=punctuation, alpha=alpha))
     if not case:
         # Convert all letters to lowercase
         text = text.lower()
     return text
 
-def gettext(filepath):
-    ext = os.path.splitext(filepath)[1]
+# Format a batch of documents at once. Whitespace is trimmed per document, after which the documents are joined by a
+# separator that none of the remaining steps touch so they run in one pass over the whole batch.
+def formattexts(texts, notrim=False, punctuation=False, alpha=False, case=False, quiet=False, verbose=False):
+    if len(texts) < 2 or any(BATCH_SEPARATOR in text for text in texts):
+        return [formattext(text, notrim=notrim, punctuation=punctuation, alpha=alpha, case=case, quiet=quiet, verbose=verbose) for text in texts]
+    if not notrim:
+        # Remove all whitespace and replace with singular space
+        texts = [" ".join(text.split()) for text in texts]
+    text = formattext(BATCH_SEPARATOR.join(texts), notrim=True, punctuation=punctuation, alpha=alpha, case=case, quiet=quiet, verbose=verbose)
+    return text.split(BATCH_SEPARATOR)
 
-    #switch on extension to handle different file types
+def gettext(filepath, cache=None, digest=None):
+    return extractdocument(filepath, cache=cache, digest=digest)[0]
 
-    return readflat(filepath)
+# Text of a PDF document extracted with pdfminer.six
+def readpdf(filepath):
+    try:
+        from pdfminer.high_level import extract_text
+    except ImportError:
+        raise ImportError("The pdfminer.six package is required to read '" + filepath + "'.")
+    return extract_text(filepath), os.path.getsize(filepath), "pdf"
 
+# Collects the displayed text of an HTML document
+class HTMLText(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.hidden = 0
 
-def readpdf(filepath):
-    pass
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_HIDDEN_TAGS:
+            self.hidden += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self.parts.append("\n")
 
-def readflat(filepath):
-    with open(filepath, "r") as document:
-        text = "".join(document.readlines())
-    return text
+    def handle_endtag(self, tag):
+        if tag in HTML_HIDDEN_TAGS:
+            self.hidden = max(0, self.hidden - 1)
+        elif tag in HTML_BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.parts.append(data)
+
+    def gettext(self):
+        return "".join(self.parts)
+
+def readhtml(filepath):
+    text, bytecount, encoding = readdocument(filepath)
+    parser = HTMLText()
+    parser.feed(text)
+    parser.close()
+    return parser.gettext(), bytecount, encoding
+
+# Extractor of the files with each (lowercase) extension and whether it is isolated. Every extractor returns the text,
+# byte length and encoding (or format) of a file like readdocument. Isolated extractors are expensive or unreliable
+# parsers: they are run by an ExtractPool with a time and memory limit for every file and their results are cached.
+EXTRACTORS = {".html": (readhtml, False), ".htm": (readhtml, False), ".pdf": (readpdf, True)}
+# Package (distribution name) each extractor parses with. Failures cached for an extractor are retried once the
+# installed version of its package changes.
+EXTRACTOR_PACKAGES = {"readpdf": "pdfminer.six"}
+
+# Add an extractor for the given extensions, replacing the current one. Extractors have to be defined at module level
+# so that they can be sent to other processes.
+def registerextractor(exts, extractor, isolated=False, package=None):
+    for ext in exts:
+        EXTRACTORS[ext.lower()] = (extractor, isolated)
+    if package:
+        EXTRACTOR_PACKAGES[extractor.__name__] = package
+
+# Extractor of a file by its extension. All other files are read as flat text.
+def getextractor(filepath):
+    return EXTRACTORS.get(os.path.splitext(filepath)[1].lower(), (readdocument, False))
+
+def extractkey(digest, extractor):
+    return digest + "_" + extractor.__name__
+
+# Installed version of the package of an extractor, None when it has none or it is not installed
+def extractversion(extractor):
+    import importlib.metadata
+    package = EXTRACTOR_PACKAGES.get(extractor.__name__)
+    if package is None:
+        return None
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+# Text, byte length and encoding of a document read with the extractor of its type. Documents of isolated extractors
+# are taken from the cache when given, keyed by the content hash 'digest' (computed when not given). Documents missing
+# from the cache are extracted in this process.
+def extractdocument(filepath, cache=None, digest=None):
+    extractor, isolated = getextractor(filepath)
+    if isolated and cache is not None:
+        document = cache.load(extractkey(digest or hashfile(filepath), extractor))
+        if document is not None:
+            return document
+    return extractor(filepath)
+
+# Documents extracted by the isolated extractors, stored as JSON [text, byte length, encoding] under their key so that
+# later runs do not parse the same file again. Files which could not be extracted are stored as JSON [error, version]
+# along with the version of the extractor's package, so they are not parsed again (and waited for until the timeout)
+# with the same version. Entries are never removed.
+class ExtractCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key, ext=EXTRACT_CACHE_EXT):
+        return os.path.join(self.directory, key[:2], key + ext)
+
+    def contains(self, key):
+        return os.path.isfile(self.path(key))
+
+    def load(self, key, ext=EXTRACT_CACHE_EXT):
+        try:
+            with open(self.path(key, ext=ext), "r", encoding="utf-8") as file:
+                return tuple(json.load(file))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # Unreadable entry, it is replaced by the next store
+            return None
+
+    def store(self, key, document, ext=EXTRACT_CACHE_EXT):
+        path = self.path(key, ext=ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a name unique to the process so concurrent stores never see partial entries
+        temppath = path + "." + str(os.getpid()) + ".tmp"
+        with open(temppath, "w", encoding="utf-8") as file:
+            json.dump(list(document), file, ensure_ascii=False)
+        os.replace(temppath, path)
+
+    # Error of a failed extraction with the given package version, None if it did not fail with that version
+    def loadfailure(self, key, version):
+        failure = self.load(key, ext=EXTRACT_FAILED_EXT)
+        if failure is None or len(failure) != 2 or failure[1] != version:
+            return None
+        return failure[0]
+
+    def storefailure(self, key, error, version):
+        self.store(key, (error, version), ext=EXTRACT_FAILED_EXT)
+
+# Entry point of the processes of an ExtractPool. Receives (extractor, path) tasks until None and sends back
+# (document, None) or (None, error message) for each. The address space of the process is limited to 'memory' bytes.
+def extractworker(connection, memory=0):
+    # Interrupts are handled by the parent, which stops its extract processes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory and resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            memory = min(memory, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        extractor, filepath = task
+        try:
+            result = (extractor(filepath), None)
+        except MemoryError:
+            result = (None, "Out of memory.")
+        except Exception as error:
+            result = (None, type(error).__name__ + ": " + str(error))
+        connection.send(result)
+
+# Runs isolated extractors on up to 'processes' processes of their own, so that a file which makes its parser hang,
+# run out of memory or crash only fails that file. Each file is given 'timeout' seconds after which its process is
+# killed and replaced. Processes are started when first needed and kept for the following files.
+class ExtractPool:
+    def __init__(self, processes, timeout=EXTRACT_TIMEOUT, memory=0):
+        self.processes = processes
+        self.timeout = timeout
+        self.memory = memory
+        self.idle = []
+        self.workers = []
+
+    def start(self):
+        connection, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=extractworker, args=(child, self.memory), daemon=True)
+        process.start()
+        child.close()
+        worker = (process, connection)
+        self.workers.append(worker)
+        return worker
+
+    def stop(self, worker):
+        process, connection = worker
+        process.kill()
+        process.join()
+        connection.close()
+        self.workers.remove(worker)
+
+    # Extract every (key, extractor, path) task. Yields (key, document, error) as the tasks finish, error is None for
+    # extracted documents.
+    def extract(self, tasks):
+        tasks = list(reversed(tasks))
+        busy = {}
+        while tasks or busy:
+            while tasks and len(busy) < self.processes:
+                worker = self.idle.pop() if self.idle else self.start()
+                key, extractor, filepath = tasks.pop()
+                worker[1].send((extractor, filepath))
+                busy[worker[1]] = (worker, key, time.monotonic() + self.timeout)
+            wait = min([deadline for worker, key, deadline in busy.values()]) - time.monotonic()
+            for connection in multiprocessing.connection.wait(list(busy), timeout=max(0, wait)):
+                worker, key, deadline = busy.pop(connection)
+                try:
+                    document, error = connection.recv()
+                except (EOFError, OSError):
+                    self.stop(worker)
+                    yield key, None, "The extract process exited with code " + str(worker[0].exitcode) + "."
+                    continue
+                self.idle.append(worker)
+                yield key, document, error
+            now = time.monotonic()
+            for connection, (worker, key, deadline) in list(busy.items()):
+                if deadline <= now:
+                    del busy[connection]
+                    self.stop(worker)
+                    yield key, None, "Timed out after " + str(self.timeout) + " seconds."
+
+    def close(self):
+        for worker in list(self.workers):
+            if worker in self.idle:
+                try:
+                    worker[1].send(None)
+                except OSError:
+                    pass
+                worker[0].join(1)
+            self.stop(worker)
+        self.idle = []
+
+# Encoding of the byte order mark a document starts with, None without one
+def detectbom(filepath):
+    with openinput(filepath) as document:
+        data = document.read(4)
+    for bom, encoding in TEXT_BOMS:
+        if data.startswith(bom):
+            return encoding
+    return None
+
+# Decode a document block by block. Yields the text of every block along with the number of bytes read for it. Line
+# breaks are translated as in decodetext.
+def decodeblocks(filepath, encoding, blocksize=STREAM_BLOCKSIZE):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    carry = ""
+    with openinput(filepath) as document:
+        while True:
+            data = document.read(blocksize)
+            text = carry + decoder.decode(data, final=not data)
+            carry = ""
+            # Keep a "\r" back as a "\r\n" may be split over two blocks
+            if data and text.endswith("\r"):
+                text, carry = text[:-1], "\r"
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            yield text, len(data)
+            if not data:
+                return
+
+# Split decoded blocks into records at every 'delimiter' (which is dropped) or after every 'lines' lines, or not at
+# all. Records are cut into pieces after whitespace so no word, line break or delimiter is split over two pieces.
+# Yields (piece, bytes read, end of record), the bytes read since the previous piece counted in the next one. An empty
+# last record of a split document is dropped.
+def splitblocks(blocks, delimiter=None, lines=0):
+    pending = ""
+    remaining = lines
+    bytecount = 0
+    # Number of records ended and whether pieces of the next record were yielded
+    ended = 0
+    started = False
+    for text, count in blocks:
+        bytecount += count
+        start = len(pending)
+        pending += text
+        limit = len(pending)
+        if delimiter:
+            *records, pending = pending.split(delimiter)
+            for record in records:
+                yield record, bytecount, True
+                bytecount = 0
+                ended += 1
+                started = False
+            # A delimiter may start in the text held back
+            start = 0
+            limit = max(len(pending) - len(delimiter) + 1, 0)
+        elif lines:
+            begin = 0
+            while True:
+                end = begin - 1
+                for line in range(remaining):
+                    end = pending.find("\n", end + 1)
+                    if end < 0:
+                        break
+                if end < 0:
+                    break
+                yield pending[begin:end + 1], bytecount, True
+                bytecount = 0
+                ended += 1
+                started = False
+                begin = end + 1
+                remaining = lines
+            if begin:
+                pending = pending[begin:]
+                start = 0
+                limit = len(pending)
+        if not count:
+            break
+        # Cut after the last whitespace of the new text (or of all pending text once records were split off)
+        cut = max([pending.rfind(char, start, limit) for char in STREAM_CUTS])
+        if cut < 0:
+            continue
+        piece, pending = pending[:cut + 1], pending[cut + 1:]
+        remaining -= piece.count("\n") if lines else 0
+        yield piece, bytecount, False
+        bytecount = 0
+        started = True
+    if pending or started or not ended:
+        yield pending, bytecount, True
+
+# Read, format and save a document block by block so its size is not bound by memory. With a delimiter or a number of
+# lines the document is split into records (see splitblocks). Every record is formatted as formattext would, saved to
+# a file in 'directory' named after 'filename' and the record number, and its metadata is counted along the way.
+# Given 'ids' the formatted words are tokenized as well (see tokenizetexts). Returns (meta, path, tokens) of every
+# record. A document which is not valid in an encoding is read again from the start in the next one.
+def streamdocument(filepath, directory, filename, delimiter=None, lines=0, extended=False, ids=None, notrim=False, punctuation=False, alpha=False, case=False, compress=False, abspath=False, codec="gzip", level=None, blocksize=STREAM_BLOCKSIZE):
+    import numpy as np
+    encoding = detectbom(filepath)
+    encodings = [encoding] + TEXT_ENCODINGS if encoding else TEXT_ENCODINGS
+    translation = None
+    if not punctuation or alpha:
+        translation = gettranslation(punctuation=punctuation, alpha=alpha)
+    for encoding in encodings:
+        records = []
+        file = None
+        try:
+            for piece, bytecount, end in splitblocks(decodeblocks(filepath, encoding, blocksize=blocksize), delimiter=delimiter, lines=lines):
+                if file is None:
+                    path = outputpath(filename + "_" + str(len(records)), directory, compress=compress, abspath=abspath, codec=codec)
+                    file = opentext(path, compress=compress, codec=codec, level=level)
+                    charcount = wordcount = linecount = sourcebytes = 0
+                    unique = set()
+                    arrays = []
+                    started = False
+                    last = ""
+                if extended:
+                    # Records split off a document count the length of their text in the encoding of the document
+                    sourcebytes += len(piece.encode(encoding)) if delimiter or lines else bytecount
+                text = piece
+                if not notrim:
+                    # Words of earlier pieces are joined to those of this piece by a single space
+                    words = piece.split()
+                    text = " ".join(words)
+                    if started and words:
+                        text = " " + text
+                    started = started or bool(words)
+                if translation:
+                    text = text.translate(translation)
+                if not case:
+                    text = text.lower()
+                file.write(text)
+                charcount += len(text)
+                words = text.split()
+                wordcount += len(words)
+                if extended:
+                    linecount += piece.count("\n")
+                    last = piece[-1:] or last
+                    unique.update(words)
+                if ids is not None:
+                    arrays.append(np.array([ids.setdefault(word, len(ids)) for word in words], dtype=np.uint32))
+                if end:
+                    file.close()
+                    file = None
+                    meta = [charcount, wordcount]
+                    if extended:
+                        # Lines are counted as readlines would
+                        linecount += 1 if last and last != "\n" else 0
+                        meta += [linecount, len(unique), sourcebytes, encoding]
+                    records.append((meta, path, np.concatenate(arrays) if ids is not None else None))
+            return records
+        except UnicodeDecodeError:
+            if file is not None:
+                file.close()
+                os.remove(path)
+            for meta, path, tokens in records:
+                os.remove(path)
+
+# MinHash signature of a document read block by block like streamdocument, equal to that of its whole text (see
+# fingerprintchunk). A signature is the minimum over all shingles, so the signatures of the blocks are merged by their
+# minimum. The last SHINGLE_SIZE - 1 words of a block are carried into the next one so the shingles crossing blocks
+# are counted. None for a document without words.
+def streamsignature(filepath, blocksize=STREAM_BLOCKSIZE):
+    import numpy as np
+    encoding = detectbom(filepath)
+    encodings = [encoding] + TEXT_ENCODINGS if encoding else TEXT_ENCODINGS
+    translation = gettranslation()
+    for encoding in encodings:
+        signature = None
+        carry = []
+        try:
+            for piece, bytecount, end in splitblocks(decodeblocks(filepath, encoding, blocksize=blocksize)):
+                words = carry + piece.lower().translate(translation).split()
+                if len(words) < SHINGLE_SIZE:
+                    carry = words
+                    continue
+                values = minhash(getshingles(words))
+                signature = values if signature is None else np.minimum(signature, values)
+                carry = words[len(words) - SHINGLE_SIZE + 1:]
+        except UnicodeDecodeError:
+            continue
+        if signature is None and carry:
+            # Fewer words than a shingle
+            signature = minhash(getshingles(carry))
+        return signature
+
+# Start the optional profilers of the main process
+def startprofile(profile=None, tracemem=0):
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if tracemem:
+        tracemalloc.start()
+    return profiler
+
+# Stop the profilers. The cProfile statistics are written to the profile file and the largest allocation sites found
+# by tracemalloc are returned so they can be added to the stats file.
+def stopprofile(profiler, profile=None, tracemem=0):
+    extra = {}
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile)
+    if tracemem:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        top = snapshot.statistics("lineno")[:tracemem]
+        extra["memory"] = {"current_bytes": current, "peak_bytes": peak, "top": [{"location": str(stat.traceback), "bytes": stat.size, "count": stat.count} for stat in top]}
+    return extra
+
+# Read, format and check a chunk of documents. Documents reusing the output of a previous run are passed straight
+# through, new manifest records get the content hash. When a directory is given each useful text is saved under a
+# temporary name (numbered by the job index) and its path is returned in place of the text; the parent renames it
+# once the final index is known. With extended set the metadata holds the statistics of the columnar metadata formats.
+# With tokenize set every useful text (reused ones read back from their output) is tokenized, see tokenizetexts; the
+# arrays are in the order of the results. Documents of at least 'streamsize' bytes, or all documents when splitting by
+# delimiter or lines, are streamed into temporary files in 'streamdir' (see streamdocument) and give a result for
+# every record. Only flat documents are streamed, documents of other types are extracted whole (see EXTRACTORS) and
+# those of isolated extractors are taken from the extraction cache directory when given. 'saved' tells whether the
+# text of a result is the path of a temporary file. With timed set the stage timings of the whole chunk are returned
+# as well.
+def processchunk(chunk, directory=None, extended=False, tokenize=False, streamdir=None, streamsize=0, delimiter=None, lines=0, cache=None, notrim=False, punctuation=False, alpha=False, case=False, minchars=0, maxchars=0, compress=False, abspath=False, codec="gzip", level=None, quiet=False, verbose=False, timed=False):
+    timings = {} if timed else None
+    streamed = set()
+    if streamdir is not None:
+        streamed = set([job[0] for job in chunk if not job[4] and getextractor(job[1])[0] is readdocument and (delimiter or lines or (streamsize and os.path.getsize(job[1]) >= streamsize))])
+    todo = [job for job in chunk if not job[4] and job[0] not in streamed]
+    if cache is not None:
+        cache = ExtractCache(cache)
+    texts = []
+    sources = []
+    with timestage(timings, "read"):
+        for job in todo:
+            digest = job[3]["hash"] if job[3] is not None else None
+            if extended:
+                text, bytecount, encoding = extractdocument(job[1], cache=cache, digest=digest)
+                # Lines of the source document, counted as readlines would
+                linecount = text.count("\n") + (1 if text and not text.endswith("\n") else 0)
+                sources.append((linecount, bytecount, encoding))
+            else:
+                text = gettext(job[1], cache=cache, digest=digest)
+            texts.append(text)
+    with timestage(timings, "format"):
+        texts = formattexts(texts, notrim=notrim, punctuation=punctuation, alpha=alpha, case=case, quiet=quiet, verbose=verbose)
+    texts = iter(texts)
+    sources = iter(sources)
+    results = []
+    encode = []
+    ids = {} if tokenize else None
+    for j, filepath, labels, record, reuse in chunk:
+        if reuse:
+            results.append((filepath, labels, None, None, False, record, reuse))
+            # The vocabulary is built anew every run
+            if tokenize and record["useful"]:
+                with timestage(timings, "read"):
+                    encode.append(readoutput(record["output"]))
+            else:
+                encode.append(None)
+            continue
+        # Already hashed by the dedup stage when deduplicating
+        if record is not None and record["hash"] is None:
+            with timestage(timings, "hash"):
+                record["hash"] = hashfile(filepath)
+        if j in streamed:
+            with timestage(timings, "stream"):
+                streams = streamdocument(filepath, streamdir, TEMP_FILE_PREFIX + str(j), delimiter=delimiter, lines=lines, extended=extended, ids=ids, notrim=notrim, punctuation=punctuation, alpha=alpha, case=case, compress=compress, abspath=abspath, codec=codec, level=level)
+            for meta, path, tokens in streams:
+                if checkuseful(meta, minchars=minchars, maxchars=maxchars, verbose=verbose):
+                    results.append((filepath, labels, meta, path, True, record, reuse))
+                    encode.append(tokens)
+                else:
+                    os.remove(path)
+                    results.append((filepath, labels, None, None, False, record, reuse))
+                    encode.append(None)
+            continue
+        text = next(texts)
+        # Generate metadata
+        with timestage(timings, "meta"):
+            meta = getmeta(text, source=next(sources) if extended else None, verbose=verbose)
+        # Check if text has actual text in it as well as matching min and max character counts
+        if not checkuseful(meta, minchars=minchars, maxchars=maxchars, verbose=verbose):
+            results.append((filepath, labels, None, None, False, record, reuse))
+            encode.append(None)
+            continue
+        encode.append(text if tokenize else None)
+        if directory is not None:
+            with timestage(timings, "save"):
+                text = savetext(text, TEMP_FILE_PREFIX + str(j), directory, compress=compress, abspath=abspath, codec=codec, level=level)
+        results.append((filepath, labels, meta, text, directory is not None, record, reuse))
+    tokens = None
+    if tokenize:
+        with timestage(timings, "tokenize"):
+            tokens = tokenizetexts(encode, ids=ids)
+    return results, tokens, timings
+
+# Index of the fingerprints of every kept file, used to find duplicates without comparing each file to every other.
+# Exact duplicates are found by content hash. Near duplicates are found through 'getkeys', which splits a fingerprint
+# into band keys such that similar fingerprints share at least one key; only files sharing a key are compared with
+# 'match'. The index is kept in memory or, given a path, in an SQLite database to bound memory on very large sources.
+class DuplicateIndex:
+    def __init__(self, getkeys=None, match=None, path=None):
+        self.getkeys = getkeys
+        self.match = match
+        self.database = None
+        self.exact = {}
+        self.buckets = {}
+        self.items = []
+        if path:
+            # The index only lives for a single run
+            if os.path.exists(path):
+                os.remove(path)
+            # Filled by the thread feeding the worker processes
+            self.database = sqlite3.connect(path, check_same_thread=False)
+            self.database.execute("PRAGMA journal_mode = OFF")
+            self.database.execute("PRAGMA synchronous = OFF")
+            self.database.execute("CREATE TABLE exact (digest TEXT PRIMARY KEY, path TEXT)")
+            self.database.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, path TEXT, fingerprint BLOB)")
+            self.database.execute("CREATE TABLE buckets (band INTEGER, key BLOB, id INTEGER)")
+            self.database.execute("CREATE INDEX bucket ON buckets (band, key)")
+
+    # Path of the first file with the same content or a matching fingerprint, None if there is none
+    def find(self, digest, fingerprint=None):
+        if self.database:
+            row = self.database.execute("SELECT path FROM exact WHERE digest = ?", (digest,)).fetchone()
+            if row:
+                return row[0]
+        elif digest in self.exact:
+            return self.exact[digest]
+        if fingerprint is None or self.getkeys is None:
+            return None
+        checked = set()
+        for band, key in enumerate(self.getkeys(fingerprint)):
+            if self.database:
+                candidates = self.database.execute("SELECT items.id, items.path, items.fingerprint FROM buckets JOIN items ON buckets.id = items.id WHERE buckets.band = ? AND buckets.key = ?", (band, key))
+            else:
+                candidates = ((id,) + self.items[id] for id in self.buckets.get((band, key), []))
+            for id, path, other in candidates:
+                if id in checked:
+                    continue
+                checked.add(id)
+                if self.match(fingerprint, other):
+                    return path
+        return None
+
+    def add(self, digest, path, fingerprint=None):
+        if self.database:
+            self.database.execute("INSERT OR IGNORE INTO exact VALUES (?, ?)", (digest, path))
+        else:
+            self.exact.setdefault(digest, path)
+        if fingerprint is None or self.getkeys is None:
+            return
+        if self.database:
+            id = self.database.execute("INSERT INTO items (path, fingerprint) VALUES (?, ?)", (path, fingerprint)).lastrowid
+            self.database.executemany("INSERT INTO buckets VALUES (?, ?, ?)", [(band, key, id) for band, key in enumerate(self.getkeys(fingerprint))])
+        else:
+            id = len(self.items)
+            self.items.append((path, fingerprint))
+            for band, key in enumerate(self.getkeys(fingerprint)):
+                self.buckets.setdefault((band, key), []).append(id)
+
+    def close(self):
+        if self.database:
+            self.database.close()
+            self.database = None
+
+# Stable hashes of the shingles of a document. Words are hashed with crc32 as hash() differs between processes, once
+# for every distinct word.
+def getshingles(words, size=SHINGLE_SIZE):
+    import numpy as np
+    table = {word: zlib.crc32(word.encode()) for word in set(words)}
+    ids = np.fromiter(map(table.__getitem__, words), dtype=np.uint64, count=len(words))
+    size = min(size, len(ids))
+    count = len(ids) - size + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    for k in range(size):
+        hashes = hashes * np.uint64(0x100000001b3) + ids[k:k + count]
+    return np.unique(hashes >> np.uint64(32))
+
+# Multipliers and offsets of the multiply-shift hash functions standing in for random permutations. Seeded so that
+# every process and run computes the same signatures.
+@functools.lru_cache(maxsize=None)
+def getpermutations(count=MINHASH_PERMUTATIONS, seed=MINHASH_SEED):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(0, np.iinfo(np.uint64).max, count, dtype=np.uint64, endpoint=True) | np.uint64(1)
+    offsets = rng.integers(0, np.iinfo(np.uint64).max, count, dtype=np.uint64, endpoint=True)
+    return multipliers[:, None], offsets[:, None]
+
+# MinHash signature of a set of shingle hashes: the minimum of every hash function over the set. The shift of the
+# multiply-shift hash keeps the order of values, so it is applied to the minimum only.
+def minhash(shingles, permutations=MINHASH_PERMUTATIONS):
+    import numpy as np
+    multipliers, offsets = getpermutations(permutations)
+    signature = np.full(permutations, np.iinfo(np.uint64).max, dtype=np.uint64)
+    buffer = np.empty((permutations, min(len(shingles), MINHASH_BLOCKSIZE)), dtype=np.uint64)
+    for start in range(0, len(shingles), MINHASH_BLOCKSIZE):
+        block = shingles[None, start:start + MINHASH_BLOCKSIZE]
+        values = buffer[:, :block.shape[1]]
+        np.multiply(multipliers, block, out=values)
+        np.add(values, offsets, out=values)
+        np.minimum(signature, values.min(axis=1), out=signature)
+    return (signature >> np.uint64(32)).astype(np.uint32)
+
+# Number of signature values per LSH band. Documents share a band with a chance of 50% at a similarity of about
+# (1 / bands) ^ (1 / rows); the largest band size keeping this below the similarity is used so that near duplicates
+# are found with high probability. Candidates are verified, so a lower threshold only costs comparisons.
+def getrows(similarity=SIMILARITY, permutations=MINHASH_PERMUTATIONS):
+    rows = 1
+    for candidate in range(1, permutations + 1):
+        if permutations % candidate == 0 and (candidate / permutations) ** (1 / candidate) <= similarity:
+            rows = candidate
+    return rows
+
+def signaturebands(fingerprint, rows=1):
+    import numpy as np
+    size = rows * np.dtype(np.uint32).itemsize
+    return [fingerprint[start:start + size] for start in range(0, len(fingerprint), size)]
+
+# The fraction of equal signature values estimates the Jaccard similarity of the shingles
+def matchsignature(fingerprint, other, similarity=SIMILARITY):
+    import numpy as np
+    return np.mean(np.frombuffer(fingerprint, dtype=np.uint32) == np.frombuffer(other, dtype=np.uint32)) >= similarity
+
+# Worker entry point of the dedup stage. Returns the jobs of a chunk with the content hash and, for minhash, the
+# signature of their file (None for documents without words). Unchanged files reuse the fingerprint of the previous
+# run and the content hash of new manifest records is kept so it is not computed again. Documents of isolated
+# extractors are taken from the extraction cache directory when given. Documents of at least 'streamsize' bytes are
+# read block by block (see streamsignature) so their size is not bound by memory.
+def fingerprintchunk(chunk, method="exact", cache=None, streamsize=0, timed=False):
+    timings = {} if timed else None
+    if cache is not None:
+        cache = ExtractCache(cache)
+    results = []
+    for job in chunk:
+        j, filepath, labels, record, reuse = job
+        if reuse and record.get("fingerprint"):
+            digest, fingerprint = record["fingerprint"]
+            results.append((job, digest, bytes.fromhex(fingerprint) if fingerprint else None))
+            continue
+        with timestage(timings, "hash"):
+            digest = hashfile(filepath)
+        if record is not None and not reuse:
+            record["hash"] = digest
+        fingerprint = None
+        if method == "minhash":
+            with timestage(timings, "fingerprint"):
+                if streamsize and getextractor(filepath)[0] is readdocument and os.path.getsize(filepath) >= streamsize:
+                    signature = streamsignature(filepath)
+                    fingerprint = signature.tobytes() if signature is not None else None
+                else:
+                    # Shingles of the lowercase words without punctuation
+                    words = gettext(filepath, cache=cache, digest=digest).lower().translate(gettranslation()).split()
+                    if words:
+                        fingerprint = minhash(getshingles(words)).tobytes()
+        results.append((job, digest, fingerprint))
+    return results, timings
+
+# Extract the documents of isolated extractors (see EXTRACTORS) into the cache on the processes of the pool, a chunk
+# of jobs at a time, before they are processed. Documents already in the cache are not extracted again. The jobs of
+# documents which cannot be extracted (parse errors, timeouts, the memory limit) are dropped and listed in the failures
+# file along with the reason. Failures are cached as well and only extracted again with a new version of the
+# extractor's package, or with retry.
+def extractjobs(chunks, pool, cache, failures, retry=False, stats=None):
+    lines = csv.writer(failures, lineterminator="\n")
+    versions = {}
+    for chunk in chunks:
+        keys = {}
+        tasks = {}
+        errors = {}
+        for j, filepath, labels, record, reuse in chunk:
+            extractor, isolated = getextractor(filepath)
+            if reuse or not isolated:
+                continue
+            if record is not None:
+                if record["hash"] is None:
+                    record["hash"] = hashfile(filepath)
+                digest = record["hash"]
+            else:
+                digest = hashfile(filepath)
+            keys[j] = extractkey(digest, extractor)
+            # Identical files are extracted once
+            if keys[j] in tasks or keys[j] in errors or cache.contains(keys[j]):
+                continue
+            if extractor not in versions:
+                versions[extractor] = extractversion(extractor)
+            error = None if retry else cache.loadfailure(keys[j], versions[extractor])
+            if error is not None:
+                errors[keys[j]] = error
+            else:
+                tasks[keys[j]] = (keys[j], extractor, filepath)
+        for key, document, error in pool.extract(list(tasks.values())):
+            if error is None:
+                cache.store(key, document)
+            else:
+                errors[key] = error
+                cache.storefailure(key, error, versions[tasks[key][1]])
+        kept = []
+        for job in chunk:
+            error = errors.get(keys.get(job[0]))
+            if error is not None:
+                lines.writerow([job[1], error])
+                if stats:
+                    stats.count("failed")
+                continue
+            kept.append(job)
+        if kept:
+            yield kept
+
+# Drop the jobs of duplicate files, keeping the first file (in walk order) of every group of duplicates. Duplicates
+# are listed in the duplicates file along with the file they duplicate. Kept jobs store their fingerprint in their
+# manifest record so unchanged files are not fingerprinted again.
+def dedupjobs(chunks, index, duplicates, stats=None):
+    lines = csv.writer(duplicates, lineterminator="\n")
+    for results, timings in chunks:
+        for job, digest, fingerprint in results:
+            j, filepath, labels, record, reuse = job
+            with timestage(timings, "dedup"):
+                original = index.find(digest, fingerprint)
+                if original is None:
+                    index.add(digest, filepath, fingerprint)
+            if original is not None:
+                lines.writerow([filepath, original])
+                if stats:
+                    stats.count("duplicate")
+                continue
+            if record is not None:
+                record["fingerprint"] = [digest, fingerprint.hex() if fingerprint else None]
+            yield job
+        if stats and timings:
+            stats.add(timings)
+
+# Attach the manifest record to each job. Unchanged files reuse the record of the previous run, all others get a new
+# record. Without a manifest there are no records.
+def planjobs(jobs, previous=None):
+    for j, filepath, labels in jobs:
+        if previous is None:
+            yield j, filepath, labels, None, False
+            continue
+        stat = os.stat(filepath)
+        record = previous.get(filepath)
+        if checkunchanged(record, filepath, stat.st_size, stat.st_mtime_ns):
+            yield j, filepath, labels, record, True
+        else:
+            record = {"source": filepath, "size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": None}
+            yield j, filepath, labels, record, False
+
+def chunkjobs(jobs, size):
+    chunk = []
+    for job in jobs:
+        chunk.append(job)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 def main():
     parser = argparse.ArgumentParser(description="Do preprocessing on text data for supervised learning tasks. Take text files from source directories and perform preprocessing operation on each document. By default excess whitespace from text is removed (leading and trailing whitespace is removed, and all whitespace between words is reduced to a singular space), all letters are converted to lowercase, and all punctuation is removed. The directory tree determines the data labels such that each folder name is a label for all texts held within itself and its subdirectories. Whitespace in labels will be replaced with underscores. Export each text as a flat file to the target directory along with a single metadata file 'metadata.csv' holding the labels, text properties, and the path to the flattened text file. Texts that are unlabeled will have their paths exported to a file 'unlabeled.csv' in the same directory as the metadata file. Texts that contain useless data will have their paths exported to a file 'useless.csv' in the same directory as the metadata file.")
@@ -198,8 +1374,14 @@ def main():
     parser.add_argument("-m", "--metadata", type=str, help="Optional path to the metadata file. If unset then metadata file will be stored in the target directory.")
     parser.add_argument("-s", "--source", action="append", type=str, help="Path to the source directory holding text files to be processed. The folder names of the directory tree determines the labels for each text. Each extra argument will add another source directory to the list of directories.")
     parser.add_argument("-r", "--root", action="store_true", help="Do not ignore the root directory name in the labeling process for each source file.")
-    parser.add_argument("-c", "--compress", action="store_true", help="Compress each output file using GNU zip (.gz).")
+    parser.add_argument("-c", "--compress", action="store_true", help="Compress each output file as it is written. Uses GNU zip (.gz) unless another codec is chosen.")
+    parser.add_argument("--codec", choices=COMPRESSION_CODECS, default="gzip", help="Compression codec used with --compress. zstd and lz4 require the zstandard and lz4 packages.")
+    parser.add_argument("--level", type=int, help="Compression level used with --compress. Defaults to a fast level for the chosen codec.")
+    parser.add_argument("--writers", type=int, default=2, help="Number of background threads compressing and writing (or renaming the worker output to) output files.")
+    parser.add_argument("--writequeue", type=int, default=WRITER_PENDING, help="Maximum number of output files waiting for the writer threads. Processing is held back while the queue is full, which caps the memory held by pending output.")
+    parser.add_argument("--fsync", type=int, default=0, help="Sync output files to stable storage in batches of the given number of files (shards are synced as they are flushed). By default outputs are left to the operating system to write back.")
     parser.add_argument("-o", "--override", action="store_true", help="Allows for the target directory to be an existing directory and will override any existing files if collision occurs during export.")
+    parser.add_argument("-u", "--incremental", action="store_true", help="Keep a manifest of every source file (size, modification time and content hash) and its output in the metadata directory. Later runs into the same target only process new or modified files, remove the output of deleted files and resume a crashed run. Requires the same output options as the previous run.")
     parser.add_argument("-a", "--abspath", action="store_true", help="Force absolute path names.")
     parser.add_argument("-t", "--notrim", action="store_true", help="Do not trim text such that all original whitespace is kept.")
     parser.add_argument("-p", "--punctuation", action="store_true", help="Keep original punctuation in document; do not remove punctuation.")
@@ -207,13 +1389,38 @@ def main():
     parser.add_argument("-k", "--case", action="store_true", help="Keep original letter case in document; do not convert text to all lowercase letters.")
     parser.add_argument("-i", "--minchars", type=int, default=0, help="Optional flag setting the minimum characters allowed for text to be considered useful data.")
     parser.add_argument("-f", "--maxchars", type=int, default=0, help="Optional flag setting the maximum characters allowed for text to be considered useful data.")
+    parser.add_argument("--dedup", choices=DEDUP_METHODS, help="Skip duplicate documents before they are formatted and saved, keeping the first of every group of duplicates. Duplicates are found by identical file content (exact) and optionally by the estimated similarity of their word shingles (minhash). Duplicates are listed along with the document they duplicate in the file 'duplicates.csv' in the same directory as the metadata file.")
+    parser.add_argument("--similarity", type=float, default=SIMILARITY, help="Minimum estimated similarity (0-1, Jaccard similarity of the word shingles) of near duplicate documents.")
+    parser.add_argument("--dedupindex", type=str, help="Path to an SQLite database holding the dedup index instead of memory, for sources of many millions of documents. The database is replaced on every run.")
+    parser.add_argument("--metaformat", choices=METADATA_FORMATS, default="text", help="Format of the metadata file: space separated text lines ('metadata.csv'), a structured NumPy array ('metadata.npy') or a Parquet table ('metadata.parquet'). The columnar formats keep labels as they are and add the line count, number of unique words, byte length and detected encoding of every document. Parquet requires the pyarrow package.")
+    parser.add_argument("--vocab", action="store_true", help="Build a vocabulary of the words of all exported documents, sorted by frequency, and store every document as an array of token ids. The vocabulary ('vocab.txt', one word and its count per line, line number is the token id), the token ids ('tokens.bin', uint16 if the vocabulary has at most 65536 words and uint32 otherwise) and the offsets of every metadata record in the token ids ('tokens_index.npy') are stored in the same directory as the metadata file.")
+    parser.add_argument("--mincount", type=int, default=1, help="Minimum number of uses of a word for it to be in the vocabulary. Other words are encoded as the unknown token (id 0).")
+    parser.add_argument("--vocabsize", type=int, default=0, help="Maximum number of words of the vocabulary including the unknown token. Only the most frequent words are kept. By default the vocabulary is not limited.")
+    parser.add_argument("--streamsize", type=float, default=0, help="Stream source files of at least the given number of megabytes: they are read, formatted, saved and fingerprinted for --dedup in blocks so their size is not limited by memory. By default no file is streamed.")
+    parser.add_argument("--splitby", type=str, help="Split every source file into several documents at each occurrence of the given delimiter (backslash escapes such as \\n are understood). Documents split off a file have the labels of the file. Implies streaming.")
+    parser.add_argument("--splitlines", type=int, default=0, help="Split every source file into documents of the given number of lines. Implies streaming.")
+    parser.add_argument("--extractcache", type=str, help="Directory of a cache of the text extracted from PDF files (and other files of isolated extractors) by content hash, shared between runs so the same file is never parsed again. By default a temporary cache is used for the run.")
+    parser.add_argument("--extracttimeout", type=float, default=EXTRACT_TIMEOUT, help="Maximum number of seconds spent extracting the text of a PDF file. Files taking longer are listed with the reason in the file 'failed.csv' in the same directory as the metadata file, as are files which cannot be parsed.")
+    parser.add_argument("--retryfailed", action="store_true", help="Extract the files again which failed to be extracted in an earlier run using the same --extractcache. By default they are only retried once the version of the package parsing them changes, and listed in 'failed.csv' with the earlier reason.")
+    parser.add_argument("--extractmemory", type=int, default=EXTRACT_MEMORY, help="Maximum address space in megabytes of each process extracting the text of PDF files, 0 for no limit. Not enforced on every platform.")
+    parser.add_argument("--extractworkers", type=int, help="Number of processes extracting the text of PDF files ahead of processing. Defaults to the number of workers. PDF files require the pdfminer.six package.")
+    parser.add_argument("--storage", choices=STORAGE_TYPES, default="text", help="Output storage of the formatted documents: one text file per document (text) or large shard files holding many documents (shard). Documents in a shard are located by byte offset and length and can be read directly from a memory map.")
+    parser.add_argument("--shardsize", type=int, default=1024, help="Maximum size of each shard file in megabytes when using shard storage.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes reading, formatting and saving documents. Output numbering and metadata are identical to a single process run.")
+    parser.add_argument("--chunksize", type=int, default=WORKER_CHUNKSIZE, help="Number of documents formatted together as one batch and handed to a worker at a time.")
+    parser.add_argument("--scanthreads", type=int, default=SCAN_THREADS, help="Number of threads listing source directories ahead of processing.")
+    parser.add_argument("--metabatch", type=int, default=METADATA_BATCHSIZE, help="Number of metadata, unlabeled and useless records buffered before they are written to disk.")
+    parser.add_argument("--stats", type=str, help="Path to a JSON file in which the number of files, throughput and the cumulative time and duration histogram of every pipeline stage are stored at the end of the run.")
+    parser.add_argument("--progress", type=float, default=0, help="Print a progress line at most once every given number of seconds instead of a line for every file.")
+    parser.add_argument("--profile", type=str, help="Profile the main process with cProfile and store the statistics in the given file.")
+    parser.add_argument("--tracemalloc", type=int, default=0, help="Trace memory allocations of the main process and add the given number of largest allocation sites to the stats file.")
     log_group = parser.add_mutually_exclusive_group()
     log_group.add_argument("-v", "--verbose", action="store_true", help="Output actions to the console and show detailed information.")
     log_group.add_argument("-q", "--quiet", action="store_true", help="Suppress ouptut to the console.")
 
     args = parser.parse_args()
 
-    if createdir(args.target, dirlabel="target", clean=(not args.override), verbose=args.verbose, quiet=args.quiet):
+    if createdir(args.target, dirlabel="target", clean=(not args.override and not args.incremental), verbose=args.verbose, quiet=args.quiet):
         sys.exit()
     if checkdirs(args.source, dirlabel="source", verbose=args.verbose, quiet=args.quiet):
         sys.exit()
@@ -230,61 +1437,264 @@ def main():
             print("Maximum/minimum characters flag value is less than 0.")
             sys.exit()
 
+    if args.compress and args.storage == "shard":
+        if not args.quiet:
+            print("Compression is not supported for shard storage.")
+        sys.exit()
+    if args.compress and not checkcodec(args.codec):
+        if not args.quiet:
+            print("The package required for the " + args.codec + " codec is not installed.")
+        sys.exit()
+    if args.writers < 1 or args.writequeue < 1:
+        if not args.quiet:
+            print("Number of writers and size of the write queue must be at least 1.")
+        sys.exit()
+    if args.fsync < 0:
+        if not args.quiet:
+            print("Number of files per sync must not be negative.")
+        sys.exit()
+    if args.workers < 1 or args.chunksize < 1:
+        if not args.quiet:
+            print("Number of workers and chunk size must be at least 1.")
+        sys.exit()
+    if args.metaformat == "parquet" and importpyarrow()[0] is None:
+        if not args.quiet:
+            print("The pyarrow package is required for the parquet metadata format.")
+        sys.exit()
+    if args.streamsize < 0 or args.splitlines < 0 or (args.splitby is not None and not args.splitby):
+        if not args.quiet:
+            print("Stream size and number of lines per document must not be negative and the delimiter must not be empty.")
+        sys.exit()
+    if args.splitby and args.splitlines:
+        if not args.quiet:
+            print("Files can be split by delimiter or by lines but not both.")
+        sys.exit()
+    if (args.splitby or args.splitlines) and args.incremental:
+        if not args.quiet:
+            print("Splitting files is not supported with --incremental as the manifest holds one output per source file.")
+        sys.exit()
+    if args.splitby:
+        args.splitby = args.splitby.encode("latin-1", "backslashreplace").decode("unicode_escape")
+    if args.mincount < 1 or args.vocabsize < 0 or args.vocabsize == 1:
+        if not args.quiet:
+            print("Minimum word count must be at least 1 and vocabulary size at least 2 (or 0 for no limit).")
+        sys.exit()
+    if args.similarity <= 0 or args.similarity > 1:
+        if not args.quiet:
+            print("Similarity must be greater than 0 and at most 1.")
+        sys.exit()
+    if args.extractworkers is None:
+        args.extractworkers = args.workers
+    if args.extracttimeout <= 0 or args.extractmemory < 0 or args.extractworkers < 1:
+        if not args.quiet:
+            print("Extract timeout must be positive, extract memory must not be negative and number of extract workers must be at least 1.")
+        sys.exit()
+
     if not args.quiet:
         print("Starting operation...")
 
-    data = []
-    unlabeled = []
-    useless = []
+    profiler = startprofile(profile=args.profile, tracemem=args.tracemalloc)
+    stats = Stats(interval=args.progress, quiet=args.quiet)
+    timings = {} if args.stats else None
+
+    # Metadata and file lists are streamed to disk while the documents are processed. Incremental runs rewrite them
+    # in full as every source file is listed again.
+    metapath = args.metadata if args.metadata else args.target
+    # Columnar metadata is written as a whole at the end of the run
+    extended = args.metaformat != "text"
+    if extended:
+        data = opencolumns(args.metaformat, metapath, overwrite=args.incremental, batchsize=args.metabatch)
+    else:
+        data = openrecords(METADATA_FILENAME, metapath, batchsize=args.metabatch, overwrite=args.incremental)
+    unlabeled = openrecords(UNLABELED_FILENAME, metapath, batchsize=args.metabatch, overwrite=args.incremental)
+    useless = openrecords(USELESS_FILENAME, metapath, batchsize=args.metabatch, overwrite=args.incremental)
+    failures = openrecords(FAILED_FILENAME, metapath, batchsize=args.metabatch, overwrite=args.incremental)
+    # Without a cache directory extracted documents are only kept for the run
+    cache = args.extractcache if args.extractcache else os.path.join(args.target, TEMP_FILE_PREFIX + EXTRACT_CACHE_DIRNAME)
+    extractpool = ExtractPool(args.extractworkers, timeout=args.extracttimeout, memory=args.extractmemory * 1024 * 1024)
+    vocab = None
+    if args.vocab:
+        vocab = TokenWriter(metapath, mincount=args.mincount, maxsize=args.vocabsize)
+    duplicates = None
+    dedupindex = None
+    if args.dedup:
+        duplicates = openrecords(DUPLICATES_FILENAME, metapath, batchsize=args.metabatch, overwrite=args.incremental)
+        if args.dedup == "exact":
+            dedupindex = DuplicateIndex(path=args.dedupindex)
+        else:
+            dedupindex = DuplicateIndex(getkeys=functools.partial(signaturebands, rows=getrows(similarity=args.similarity)), match=functools.partial(matchsignature, similarity=args.similarity), path=args.dedupindex)
+    writer = None
+    manifest = None
+    previous = None
+    records = {}
     i = 0
-    for source in args.source:
-        for root, dirs, files in os.walk(source):
-            for file in files:
-                filepath = os.path.join(root, file)
-                if args.abspath:
-                    filepath = os.path.abspath(filepath)
-                if not args.quiet:
-                    print("Currently processing document: " + file)
-                elif args.verbose:
-                    print("Currently processing document: " + filepath)
-                labelpath = root
-                if not args.root:
-                    labelpath = removeaffix(root, prefix=source)
-                labels = getlabels(trimpathsep(labelpath), verbose=args.verbose)
-                # If data is labeled
-                if labels[0]:
-                    # Get document file ready as text
-                    text = gettext(filepath)
-                    # Format the text
-                    text = formattext(text, notrim=args.notrim, punctuation=args.punctuation, alpha=args.alpha, case=args.case, quiet=args.quiet, verbose=args.verbose)
-                    # Generate metadata
-                    meta = getmeta(text, verbose=args.verbose)
-                    # Check if text has actual text in it as well as matching min and max character counts
-                    if checkuseful(meta, minchars=args.minchars, maxchars=args.maxchars, verbose=args.verbose):
-                        # Save new formatted and flattend text
-                        flatpath = savetext(text, str(i), args.target, compress=args.compress, abspath=args.abspath)
-                        i += 1
-                        data.append([labels, meta, flatpath])
-                    else:
-                        useless.append(filepath)
+    if args.incremental:
+        options = {"target": args.target, "root": args.root, "abspath": args.abspath, "storage": args.storage, "compress": args.compress, "codec": args.codec, "notrim": args.notrim, "punctuation": args.punctuation, "alpha": args.alpha, "case": args.case, "minchars": args.minchars, "maxchars": args.maxchars, "dedup": args.dedup, "similarity": args.similarity, "metaformat": args.metaformat}
+        manifestpath = os.path.join(metapath, MANIFEST_FILENAME)
+        previous = loadmanifest(manifestpath, options, verbose=args.verbose, quiet=args.quiet)
+        indices = [record["index"] for record in previous.values() if record["index"] is not None]
+        if indices:
+            i = max(indices) + 1
+        writemanifest(manifestpath, previous, options)
+
+        # A manifest record is only committed once the output it refers to has been written
+        def commit():
+            if writer:
+                writer.drain()
+            if shards:
+                shards.flush()
 
-                # Else, data is not labeled
+        manifest = RecordWriter(manifestpath, batchsize=args.metabatch, mode='a', beforeflush=commit)
+    pool = None
+    fingerprinter = None
+    shards = None
+    try:
+        if args.storage == "shard":
+            shards = ShardWriter(args.target, args.shardsize * 1024 * 1024, abspath=args.abspath, fsync=args.fsync > 0)
+        jobs = walkfiles(args.source, unlabeled, root=args.root, abspath=args.abspath, verbose=args.verbose, quiet=args.quiet, stats=stats, progress=bool(args.progress), threads=args.scanthreads)
+        jobs = chunkjobs(planjobs(jobs, previous), args.chunksize)
+        jobs = extractjobs(jobs, extractpool, ExtractCache(cache), failures, retry=args.retryfailed, stats=stats)
+        if not shards:
+            # Writes (or the renames of worker output) overlap with processing of the following documents
+            writer = BackgroundWriter(args.writers, pending=args.writequeue, fsync=args.fsync)
+        if args.workers > 1:
+            pool = multiprocessing.Pool(args.workers)
+        streamsize = int(args.streamsize * 1024 * 1024)
+        if args.dedup:
+            fingerprint = functools.partial(fingerprintchunk, method=args.dedup, cache=cache, streamsize=streamsize, timed=bool(args.stats))
+            if pool:
+                # Fingerprints are computed by a pool of their own. dedupjobs runs on the task thread of the processing
+                # pool, which would never get to submit fingerprint tasks to its own pool while waiting for them.
+                # The window keeps the walk from being drained ahead of the processing. Its workers ignore SIGINT so
+                # that the fingerprints waited for still arrive when an interrupted run shuts the processing pool down.
+                fingerprinter = multiprocessing.Pool(args.workers, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+                jobs = dedupjobs(imapwindow(fingerprinter, fingerprint, jobs, FINGERPRINT_WINDOW * args.workers), dedupindex, duplicates, stats=stats)
+            else:
+                jobs = dedupjobs(map(fingerprint, jobs), dedupindex, duplicates, stats=stats)
+            jobs = chunkjobs(jobs, args.chunksize)
+        # Streamed documents are always saved by the worker (or the main process) as they are never held in memory
+        if pool:
+            # Shards are appended to by the parent only, so workers hand back the text instead of saving it
+            directory = None if shards else args.target
+            job = functools.partial(processchunk, directory=directory, extended=extended, tokenize=args.vocab, streamdir=args.target, streamsize=streamsize, delimiter=args.splitby, lines=args.splitlines, cache=cache, notrim=args.notrim, punctuation=args.punctuation, alpha=args.alpha, case=args.case, minchars=args.minchars, maxchars=args.maxchars, compress=args.compress, abspath=args.abspath, codec=args.codec, level=args.level, quiet=args.quiet, verbose=args.verbose, timed=bool(args.stats))
+            # imap returns results in submission order which keeps the output numbering deterministic
+            chunks = pool.imap(job, jobs)
+        else:
+            job = functools.partial(processchunk, extended=extended, tokenize=args.vocab, streamdir=args.target, streamsize=streamsize, delimiter=args.splitby, lines=args.splitlines, cache=cache, notrim=args.notrim, punctuation=args.punctuation, alpha=args.alpha, case=args.case, minchars=args.minchars, maxchars=args.maxchars, compress=args.compress, abspath=args.abspath, codec=args.codec, level=args.level, quiet=args.quiet, verbose=args.verbose, timed=bool(args.stats))
+            chunks = map(job, jobs)
+
+        for chunk, tokens, chunktimings in chunks:
+            if chunktimings:
+                stats.add(chunktimings)
+            if tokens:
+                # Token ids of the chunk in the ids of the whole vocabulary
+                words, counts, arrays = tokens
+                lookup = vocab.add(words, counts)
+                tokens = [lookup[array] if array is not None else None for array in arrays]
+            for k, (filepath, labels, meta, text, saved, record, reuse) in enumerate(chunk):
+                stats.count("processed")
+                stats.progress()
+                if reuse:
+                    # Unchanged since the previous run
+                    stats.count("reused")
+                    records[filepath] = record
+                    if record["useful"]:
+                        exportrecord(data, labels, record["meta"], record["output"])
+                        if vocab:
+                            vocab.write(tokens[k])
+                    else:
+                        useless.write(filepath + "\n")
+                    continue
+                old = previous.get(filepath) if previous else None
+                flatpath = None
+                index = None
+                if meta is not None:
+                    # Modified files keep the index of their previous output
+                    if old is not None and old["index"] is not None:
+                        index = old["index"]
+                    else:
+                        index = i
+                        i += 1
+                    # Save new formatted and flattend text. Files saved by the workers only have to be renamed.
+                    with timestage(timings, "rename" if saved and not shards else "save"):
+                        if shards:
+                            flatpath = shards.copy(text) if saved else shards.write(text)
+                        else:
+                            flatpath = outputpath(str(index), args.target, compress=args.compress, abspath=args.abspath, codec=args.codec)
+                            if saved:
+                                # Move the text saved by the worker to its final index
+                                writer.submit(flatpath, os.replace, text, flatpath)
+                            else:
+                                writer.submit(flatpath, writetext, text, flatpath, compress=args.compress, codec=args.codec, level=args.level)
+                    with timestage(timings, "export"):
+                        exportrecord(data, labels, meta, flatpath)
+                        if vocab:
+                            vocab.write(tokens[k])
+                    stats.count("useful")
                 else:
-                    if args.verbose:
-                        print("Current text is unlabeled. Text will be ignored.")
-                    unlabeled.append(filepath)
+                    useless.write(filepath + "\n")
+                    stats.count("useless")
+                if record is not None:
+                    if old is not None and old["useful"] and old["output"] != flatpath:
+                        removeoutput(old["output"])
+                    record["useful"] = meta is not None
+                    record["index"] = index
+                    record["output"] = flatpath
+                    record["meta"] = meta
+                    records[filepath] = record
+                    manifest.write(json.dumps(record) + "\n")
+                if timings:
+                    stats.add(timings)
+                    timings.clear()
 
-    if args.verbose:
-        print("Finished processing documents. Now exporting metadata...")
+        if pool:
+            pool.close()
+            pool.join()
+        if fingerprinter:
+            fingerprinter.close()
+            fingerprinter.join()
 
-    if args.metadata:
-        exportmeta(data, args.metadata)
-        exportfilelist(unlabeled, UNLABELED_FILENAME, args.metadata)
-        exportfilelist(useless, USELESS_FILENAME, args.metadata)
-    else:
-        exportmeta(data, args.target)
-        exportfilelist(unlabeled, UNLABELED_FILENAME, args.target)
-        exportfilelist(useless, USELESS_FILENAME, args.target)
+        if args.verbose:
+            print("Finished processing documents. Now exporting metadata...")
+    finally:
+        # Flush everything processed so far, even if the run was interrupted
+        # The task thread of the processing pool may be waiting for a fingerprint, so it is stopped first
+        if pool:
+            pool.terminate()
+        if fingerprinter:
+            fingerprinter.terminate()
+        extractpool.close()
+        if not args.extractcache:
+            shutil.rmtree(cache, ignore_errors=True)
+        if manifest:
+            manifest.close()
+        if shards:
+            shards.close()
+        if writer:
+            writer.close()
+        data.close()
+        if vocab:
+            vocab.close()
+        unlabeled.close()
+        useless.close()
+        failures.close()
+        if duplicates:
+            duplicates.close()
+        if dedupindex:
+            dedupindex.close()
+
+    if manifest:
+        # Drop the output of source files which no longer exist and compact the manifest
+        for source, record in previous.items():
+            if source not in records and record["useful"]:
+                if args.verbose:
+                    print("Removing output of deleted or duplicate file: " + source)
+                removeoutput(record["output"])
+        writemanifest(manifestpath, records, options)
+
+    extra = stopprofile(profiler, profile=args.profile, tracemem=args.tracemalloc)
+    if args.stats:
+        stats.export(args.stats, extra=extra)
 
     if not args.quiet:
         print("Finished operation.")
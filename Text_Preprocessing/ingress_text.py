@@ -0,0 +1,122 @@
+import os
+import argparse
+import functools
+import mmap
+
+import numpy as np
+
+import common_text as common
+
+
+def readmeta(filepath):
+    if os.path.splitext(filepath)[1] in (".npy", ".parquet"):
+        # Same records as the text format, with the extra statistics of the columnar formats
+        columns = readcolumns(filepath)
+        names = [name for name, kind in common.META_COLUMNS[1:-1]]
+        stats = zip(*[columns[name].tolist() for name in names])
+        return [[labels.split(common.LABEL_SEP), list(meta), textpath] for labels, meta, textpath in zip(columns["labels"].tolist(), stats, columns["path"].tolist())]
+    data = []
+    with open(filepath, "r") as file:
+        for line in file:
+            splitline = line.strip().split(" ")
+
+            numlabels = int(splitline[0])
+            labels = []
+            for i in range(numlabels):
+                labels.append(splitline[i+1])
+
+            charcount = int(splitline[numlabels + 1])
+            wordcount = int(splitline[numlabels + 2])
+
+            textpath = splitline[-1]
+
+            data.append([labels, [charcount, wordcount], textpath])
+
+    return data
+
+# Load columnar metadata as a dict of NumPy arrays, one per column (see common.META_COLUMNS). Queries run on whole
+# columns, e.g. columns["path"][(columns["chars"] > 100) & (columns["encoding"] == "utf-8")].
+def readcolumns(filepath):
+    if os.path.splitext(filepath)[1] == ".parquet":
+        pyarrow, parquet = common.importpyarrow()
+        if pyarrow is None:
+            raise ImportError("The pyarrow package is required to read '" + filepath + "'.")
+        table = parquet.read_table(filepath)
+        columns = {}
+        for name, kind in common.META_COLUMNS:
+            column = table.column(name)
+            if kind == "U":
+                columns[name] = np.array(column.to_pylist(), dtype=str)
+            else:
+                columns[name] = column.to_numpy()
+        return columns
+    array = np.load(filepath)
+    return {name: array[name] for name in array.dtype.names}
+
+# Words of the vocabulary written by clean_text.py --vocab, indexed by token id
+def readvocab(filepath):
+    with open(filepath, "r") as file:
+        return [line.split(" ")[0] for line in file]
+
+# Vocabulary, memory mapped token ids and offsets of the token ids of every metadata record in a metadata directory
+def readtokens(directory):
+    vocab = readvocab(os.path.join(directory, common.VOCAB_FILENAME))
+    offsets = np.load(os.path.join(directory, common.TOKENS_INDEX_FILENAME))
+    dtype = common.tokendtype(len(vocab))
+    if offsets[-1] == 0:
+        # Empty files cannot be memory mapped
+        return vocab, np.zeros(0, dtype=dtype), offsets
+    return vocab, np.memmap(os.path.join(directory, common.TOKENS_FILENAME), dtype=dtype, mode="r"), offsets
+
+# Token ids of the k-th metadata record
+def gettokens(tokens, offsets, k):
+    return tokens[offsets[k]:offsets[k + 1]]
+
+# Shards are memory mapped once and shared by every document they hold
+@functools.lru_cache(maxsize=None)
+def openshard(path):
+    with open(path, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def getdocument(meta):
+    path = meta[2]
+
+    shardpath, offset, length = common.splitlocator(path)
+    if offset is not None:
+        # Slice the document straight out of the memory mapped shard
+        return openshard(shardpath)[offset:offset + length].decode(common.SHARD_ENCODING)
+    return common.readflat(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read a dataset exported by clean_text.py and report the number of documents and labels.")
+    parser.add_argument("meta", type=str, help="Path to the metadata file of the dataset.")
+    log_group = parser.add_mutually_exclusive_group()
+    log_group.add_argument("-v", "--verbose", action="store_true", help="Output actions to the console and show detailed information.")
+    log_group.add_argument("-q", "--quiet", action="store_true", help="Suppress ouptut to the console.")
+
+    args = parser.parse_args()
+
+    data = readmeta(args.meta)
+    labels = {}
+    chars = 0
+    for meta in data:
+        label = " ".join(meta[0])
+        labels[label] = labels.get(label, 0) + 1
+        chars += len(getdocument(meta))
+    if not args.quiet:
+        print("Number of documents: " + str(len(data)))
+        print("Number of labels: " + str(len(labels)))
+        print("Number of characters: " + str(chars))
+        directory = os.path.dirname(args.meta)
+        if os.path.isfile(os.path.join(directory, common.VOCAB_FILENAME)):
+            vocab, tokens, offsets = readtokens(directory)
+            print("Vocabulary size: " + str(len(vocab)))
+            print("Number of tokens: " + str(len(tokens)))
+    if args.verbose:
+        for label, count in sorted(labels.items()):
+            print(label + ": " + str(count))
+
+
+if __name__ == "__main__":
+    main()